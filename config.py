@@ -3,7 +3,7 @@ import json
 import glob
 
 from utils import get_path_with_annotation,get_path_with_annotation_ratio
-from utils import get_weight_path
+from utils import get_weight_path,get_slice_index,SliceCatalog
 
 __disease__ = ['TMLI','TMLI_UP']
 __cnn_net__ = ['unet','unet++','FPN','deeplabv3+','att_unet','res_unet',]
@@ -55,11 +55,37 @@ SCALE = info['scale'][ROI_NAME]
 #---------------------------------
 
 #--------------------------------- mode and data path setting
+# index of the packed slice store, None if one hdf5 file per slice
+INDEX_PATH = None
+# INDEX_PATH = os.path.join(info['packed_data']['train_path'],'index.csv')
+# slices read directly from the volumes of dicom2npy, index made by converter.prepare_data.build_volume_index
+# INDEX_PATH = os.path.join(info['npy_path'],'index.csv')
+# number of neighbouring slices on each side of the 2.5d input, needs the volume index
+CONTEXT = 0
+
+# memmap cache of int16/uint8 slices (2d seg mode, augmented on gpu), None to read the hdf5 files
+MMAP_PATH = None
+# MMAP_PATH = info['mmap_data']['train_path']
+
+# slice catalog (patient, class tags and areas of each slice), None to scan the files
+CATALOG_PATH = None
+# CATALOG_PATH = info['2d_data']['catalog_path']
+# CATALOG_PATH = info['packed_data']['catalog_path']
+# True to train on the annotated slices of the catalog only (the zero setting below), needs CATALOG_PATH
+ANNOTATED_ONLY = False
+
 #all
-PATH_LIST = glob.glob(os.path.join(info['2d_data']['train_path'],'*.hdf5'))
+if MMAP_PATH is not None:
+    PATH_LIST = list(get_slice_index(os.path.join(MMAP_PATH,'index.csv')).keys())
+elif INDEX_PATH is None:
+    PATH_LIST = glob.glob(os.path.join(info['2d_data']['train_path'],'*.hdf5'))
+else:
+    PATH_LIST = list(get_slice_index(INDEX_PATH).keys())
 
 #zero
 # PATH_LIST = get_path_with_annotation(info['2d_data']['train_csv_path'],'path',ROI_NAME)
+if ANNOTATED_ONLY:
+    PATH_LIST = SliceCatalog(CATALOG_PATH).select(roi_number=ROI_NUMBER,annotated=True)
 
 #half
 # PATH_LIST = get_path_with_annotation_ratio(info['2d_data']['train_csv_path'],'path',ROI_NAME,ratio=0.5)
@@ -68,11 +94,16 @@ PATH_LIST = glob.glob(os.path.join(info['2d_data']['train_path'],'*.hdf5'))
 
 #--------------------------------- others
 INPUT_SHAPE = (448,448)
+# None to train on whole slices resized to INPUT_SHAPE, or patch size of the full-resolution slices
+PATCH_SIZE = None # (256,256)
 BATCH_SIZE = 20
 
 CKPT_PATH = './ckpt/{}/{}/{}/{}/fold{}'.format(DISEASE,MODE,VERSION,ROI_NAME,str(CURRENT_FOLD))
 
 WEIGHT_PATH = get_weight_path(CKPT_PATH)
+# resume the interrupted training from the latest full training state
+if PRE_TRAINED and CKPT_POINT and os.path.exists(os.path.join(CKPT_PATH,'latest.pth')):
+    WEIGHT_PATH = os.path.join(CKPT_PATH,'latest.pth')
 print(WEIGHT_PATH)
 
 INIT_TRAINER = {
@@ -80,7 +111,7 @@ INIT_TRAINER = {
   'encoder_name':ENCODER_NAME,
   'lr':1e-3, 
   'n_epoch':150,
-  'channels':1,
+  'channels':2 * CONTEXT + 1,
   'num_classes':NUM_CLASSES, 
   'roi_number':ROI_NUMBER,
   'scale':SCALE,
@@ -88,6 +119,24 @@ INIT_TRAINER = {
   'crop':0,
   'batch_size':BATCH_SIZE,
   'num_workers':2,
+  'index_path':INDEX_PATH,
+  'catalog_path':CATALOG_PATH,
+  'context':CONTEXT,
+  'slice_cache_size':64, # decoded slices cached by each worker for the 2.5d input
+  'block_size':None, # e.g. 8, consecutive slices drawn together to reuse the cached slices, None to shuffle
+  'distributed':False, # DistributedDataParallel, launch by: torchrun --nproc_per_node=GPU_NUM run.py -m train
+  'dist_backend':'nccl', # 'gloo' to run on cpu
+  'latest_interval':1, # epochs between two saves of latest.pth, the full training state to resume
+  'ckpt_retain':3, # best checkpoints kept while training, 0 to keep all
+  'pool_size':32,
+  'mmap_path':MMAP_PATH,
+  'compact_mask':True, # one-hot encoding of the mask on gpu
+  'cache_dir':None, # deterministic preprocessing cache of val/test, e.g. '/dev/shm/tmli_cache'
+  'gpu_aug':MMAP_PATH is not None, # batched augmentation on gpu, required by the memmap cache
+  'patch_size':PATCH_SIZE,
+  'tag_csv_path':info['2d_data']['train_csv_path'],
+  'class_freq':None, # e.g. [1]*(NUM_CLASSES-1) + [0.5], per-class target frequency, the last one for empty slices
+  'epoch_samples':None, # slices per epoch of the class-balanced sampler, None for the size of the training set
   'device':DEVICE,
   'pre_trained':PRE_TRAINED,
   'ex_pre_trained':EX_PRE_TRAINED,
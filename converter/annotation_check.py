@@ -6,6 +6,7 @@ import pandas as pd
 from tqdm import tqdm
 import json
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 
 def has_annotation(annotation, annotation_list):
@@ -17,46 +18,57 @@ def has_annotation(annotation, annotation_list):
         return False, -1
 
 
+def patient_annotation_check(ID, input_path, annotation_list):
+    '''
+    Check the rt structures of one patient.
+    Only the two ROI sequences are parsed, the ContourData values (the bulk of the file) are kept raw
+    and never decoded, only their presence is checked.
+    Return the ROI names (led by ID), the count of each annotation and the read error flag.
+    '''
+    info_item = []
+    info_item.append(ID)
+    rt_error = False
+
+    index_list = list(np.zeros((len(annotation_list), ), dtype=np.int8))
+
+    for item in os.scandir(os.path.join(input_path,ID)):
+        rt_path = glob.glob(os.path.join(item.path, '*' + ID + '*RT*'))[0]
+        rt_slice = glob.glob(os.path.join(rt_path, '*.dcm'))[0]
+        try:
+            structure = pydicom.read_file(rt_slice, stop_before_pixels=True,
+                                          specific_tags=['StructureSetROISequence', 'ROIContourSequence'])
+        except:
+            rt_error = True
+            continue    
+        else:
+            for i in range(len(structure.ROIContourSequence)):
+                info_item.append(structure.StructureSetROISequence[i].ROIName)
+                flag, index = has_annotation(
+                    structure.StructureSetROISequence[i].ROIName, annotation_list)
+                if flag:
+                    roi_contour = structure.ROIContourSequence[i]
+                    if 'ContourSequence' not in roi_contour or \
+                        not all('ContourData' in s for s in roi_contour.ContourSequence):
+                        break
+                    index_list[index] = index_list[index] + 1
+
+    return info_item, index_list, rt_error
+
+
 # CT and RT in different folders
-def annotation_check(input_path, save_path, annotation_list):
+def annotation_check(input_path, save_path, annotation_list, num_workers=8):
 
     info = []
     except_id = []
-    except_id = []
 
     patient_id = os.listdir(input_path)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        result = list(tqdm(executor.map(lambda ID: patient_annotation_check(ID, input_path, annotation_list), patient_id), total=len(patient_id)))
 
-    for ID in tqdm(patient_id):
-        print(ID)
-        info_item = []
-        info_item.append(ID)
-
-        index_list = list(np.zeros((len(annotation_list), ), dtype=np.int8))
-
-        for item in os.scandir(os.path.join(input_path,ID)):
-            rt_path = glob.glob(os.path.join(item.path, '*' + ID + '*RT*'))[0]
-            rt_slice = glob.glob(os.path.join(rt_path, '*.dcm'))[0]
-            try:
-                structure = pydicom.read_file(rt_slice)
-            except:
-                except_id.append(ID)
-                print('RT Error:%s'%ID)
-                continue    
-            else:
-                for i in range(len(structure.ROIContourSequence)):
-                    info_item.append(structure.StructureSetROISequence[i].ROIName)
-                    flag, index = has_annotation(
-                        structure.StructureSetROISequence[i].ROIName, annotation_list)
-                    if flag:
-                        try:
-                            _ = [
-                                s.ContourData for s in
-                                structure.ROIContourSequence[i].ContourSequence
-                            ]
-                        except Exception:
-                            break
-                        else:
-                            index_list[index] = index_list[index] + 1
+    for ID, (info_item, index_list, rt_error) in zip(patient_id, result):
+        if rt_error:
+            except_id.append(ID)
+            print('RT Error:%s'%ID)
         if not (np.min(index_list) == 1 and np.max(index_list) == 1):
             except_id.append(ID)
             lack_list = []
@@ -65,6 +65,52 @@ def area_compute(input_path,save_path,label_list):
     csv_file.to_csv(save_path, index=False)
 
 
+def _catalog_row(slice_id, path, label, num_class):
+    area = np.bincount(label.astype(np.int64).ravel(), minlength=num_class)[1:num_class]
+    patient, slice_index = slice_id.rsplit('_', 1)
+    return slice_id, patient, int(slice_index), path, label.shape, area
+
+
+def build_catalog(input_path,save_path,label_list,index_path=None):
+    '''
+    Build the slice catalog (utils.SliceCatalog) in one pass over the labels, a compressed .npz of columns:
+    id, patient, slice_index, path, shape, tags and area of each annotation.
+    Args:
+    - input_path: string, directory of the slice hdf5 files, ignored if index_path is given
+    - save_path: string, path of the .npz catalog
+    - label_list: list of annotation names
+    - index_path: string or None, index.csv of the packed slice store, each patient file is read once
+    '''
+    num_class = len(label_list) + 1
+    rows = []
+    if index_path is None:
+        path_list = [item.path for item in os.scandir(input_path)]
+        for count, path in enumerate(path_list):
+            label = hdf5_reader(path,'label')
+            rows.append(_catalog_row(os.path.splitext(os.path.basename(path))[0], path, label, num_class))
+            sys.stdout.write('\r Current: %d / %d'%(count + 1,len(path_list)))
+    else:
+        index_df = pd.read_csv(index_path, dtype={'id':str,'patient':str})
+        groups = index_df.groupby('path', sort=False)
+        for count, (path, group) in enumerate(groups):
+            label = hdf5_reader(path,'label')
+            for slice_id, offset in zip(group['id'].tolist(), group['offset'].tolist()):
+                rows.append(_catalog_row(slice_id, slice_id, label[offset], num_class))
+            sys.stdout.write('\r Current: %d / %d'%(count + 1,len(groups)))
+    print('\n')
+
+    slice_id, patient, slice_index, path, shape, area = zip(*rows)
+    area = np.stack(area, axis=0).astype(np.int64)
+    np.savez_compressed(save_path,
+                        id=np.array(slice_id),
+                        patient=np.array(patient),
+                        slice_index=np.array(slice_index, dtype=np.int64),
+                        path=np.array(path),
+                        shape=np.array(shape, dtype=np.int64),
+                        tags=(area > 0).astype(np.uint8),
+                        area=area)
+
+
 if __name__ == "__main__":
     # json_file = './static_files/TMLI_config.json'
     json_file = './static_files/TMLI_config_up.json'
@@ -78,3 +124,5 @@ if __name__ == "__main__":
         # save_path = info['2d_data']['test_csv_path']
         
     csv_maker(input_path,save_path,info['annotation_list'])
+    # build_catalog(input_path,info['2d_data']['catalog_path'],info['annotation_list'])
+    # build_catalog(None,info['packed_data']['catalog_path'],info['annotation_list'],index_path=os.path.join(info['packed_data']['train_path'],'index.csv'))
@@ -8,56 +8,175 @@ from tqdm import tqdm
 import time
 import shutil
 import json
+import hashlib
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from converter.dicom_reader import Dicom_Reader
-from converter.utils import save_as_hdf5
+from converter.utils import append_as_hdf5
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def get_input_signature(data_path, check='mtime'):
+    '''
+    Signature of the dicom files of a patient, to detect the changed inputs.
+    Args:
+    - data_path: string, directory of the patient
+    - check: string, 'mtime'-> relative path, size and modification time of each file, 'hash'-> md5 of the file contents
+    '''
+    md5 = hashlib.md5()
+    for root, dirs, files in os.walk(data_path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            md5.update(os.path.relpath(file_path, data_path).encode())
+            if check == 'hash':
+                with open(file_path, 'rb') as fp:
+                    for chunk in iter(lambda: fp.read(1 << 20), b''):
+                        md5.update(chunk)
+            else:
+                stat = os.stat(file_path)
+                md5.update(('%d_%d' % (stat.st_size, stat.st_mtime_ns)).encode())
+    return md5.hexdigest()
+
+
+def load_manifest(save_path):
+    manifest_path = os.path.join(save_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as fp:
+        manifest = json.load(fp)
+    # the signatures are keyed by kind, {'check':kind, 'signature':str} in the older manifests
+    for entry in manifest.values():
+        if not isinstance(entry['signature'], dict):
+            entry['signature'] = {entry.pop('check'):entry['signature']}
+    return manifest
+
+
+def save_manifest(save_path, manifest):
+    # atomic replace, the manifest stays valid if the conversion is killed
+    manifest_path = os.path.join(save_path, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=4)
+    os.replace(manifest_path + '.tmp', manifest_path)
 
 
 # dicom series and rt in different directories.
-def dicom_to_hdf5(input_path, save_path, annotation_list, target_format, sub_dir=['down','up'], resample=True):
+def convert_patient(ID, input_path, save_path, annotation_list, target_format, sub_dir=['down','up'], resample=True):
+    '''
+    Convert the dicom series and rt of one patient to ID.hdf5, the work unit of dicom_to_hdf5.
+    The file is written under a temporary name and renamed when complete,
+    each sub-series is appended to the lzf compressed datasets as soon as it is read.
+    Return the hdf5 path, None if no sub-series can be read.
+    '''
+    print('=============%s in Processing============='%ID)
+    hdf5_path = os.path.join(save_path, ID + '.hdf5')
+    tmp_path = hdf5_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    count = 0
+    data_path = os.path.join(input_path,ID)
+    for sub in sub_dir:
+        sub_path = os.path.join(data_path,sub)
+        if os.path.exists(sub_path):
+            series_path = glob.glob(os.path.join(sub_path, '*' + ID + '*CT*'))[0]
+            rt_path = glob.glob(os.path.join(sub_path, '*' + ID + '*RT*'))[0]
+            rt_path = glob.glob(os.path.join(rt_path, '*.dcm'))[0]
+            
+            try:
+                reader = Dicom_Reader(series_path, target_format, rt_path, annotation_list,trunc_flag=False, normalize_flag=False)
+            except:
+                print("Error data: %s" % ID)
+                continue
+            else:
+                if resample:
+                    images = reader.get_resample_images()
+                    labels = reader.get_resample_labels()
+                else:
+                    images = reader.get_raw_images()
+                    labels = reader.get_raw_labels()
+                append_as_hdf5(images.astype(np.int16), tmp_path, 'image')
+                append_as_hdf5(labels.astype(np.uint8), tmp_path, 'label')
+                count += 1
+    if count == 0:
+        return None
+    os.replace(tmp_path, hdf5_path)
+    print("=================%s done!================="%ID)
 
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-    else:
+    return hdf5_path
+
+
+def dicom_to_hdf5(input_path, save_path, annotation_list, target_format, sub_dir=['down','up'], resample=True, num_workers=8, check=None, overwrite=False):
+    '''
+    Convert the patients in parallel, one patient per task. The completed patients are recorded in a manifest
+    (save_path/manifest.json) and skipped when the conversion is run again.
+    Args:
+    - num_workers: integer, number of processes, 0 to convert in the current process
+    - check: string or None, None-> skip all the completed patients, 'mtime' or 'hash'-> reconvert the completed patients
+             whose dicom files changed since the conversion, see get_input_signature. If only the other kind of
+             signature was recorded, it is used to check the files and the new kind is recorded without reconverting
+    - overwrite: True to remove save_path and convert all the patients
+    '''
+    if overwrite and os.path.exists(save_path):
         shutil.rmtree(save_path)
+    if not os.path.exists(save_path):
         os.makedirs(save_path)
 
+    manifest = load_manifest(save_path)
     path_list = os.listdir(input_path)
-    start = time.time()
-    for ID in tqdm(path_list):
-        print('=============%s in Processing============='%ID)
-        tmp_images = []
-        tmp_labels = []
+    task_list = []
+    # the cheap mtime signature is recorded when no check is asked, for the later runs
+    kind = 'mtime' if check is None else check
+    updated = False
+    for ID in path_list:
         data_path = os.path.join(input_path,ID)
-        for sub in sub_dir:
-            sub_path = os.path.join(data_path,sub)
-            if os.path.exists(sub_path):
-                series_path = glob.glob(os.path.join(sub_path, '*' + ID + '*CT*'))[0]
-                rt_path = glob.glob(os.path.join(sub_path, '*' + ID + '*RT*'))[0]
-                rt_path = glob.glob(os.path.join(rt_path, '*.dcm'))[0]
-                
+        done = ID in manifest and os.path.exists(os.path.join(save_path, ID + '.hdf5'))
+        if done and check is None:
+            continue
+        signature = get_input_signature(data_path, kind)
+        if done:
+            recorded = manifest[ID]['signature']
+            if kind in recorded:
+                if recorded[kind] == signature:
+                    continue
+            else:
+                # recorded with the other kind, the files are unchanged if it still matches
+                other = next(iter(recorded))
+                if recorded[other] == get_input_signature(data_path, other):
+                    recorded[kind] = signature
+                    updated = True
+                    continue
+        task_list.append((ID, signature))
+    if updated:
+        save_manifest(save_path, manifest)
+    print('%d / %d patients to convert' % (len(task_list), len(path_list)))
+
+    def record(ID, signature, hdf5_path):
+        if hdf5_path is None:
+            print("No series converted: %s" % ID)
+            return
+        manifest[ID] = {'signature':{kind:signature}, 'path':hdf5_path, 'time':time.strftime('%Y-%m-%d %H:%M:%S')}
+        save_manifest(save_path, manifest)
+
+    start = time.time()
+    if num_workers == 0:
+        for ID, signature in tqdm(task_list):
+            hdf5_path = convert_patient(ID, input_path, save_path, annotation_list, target_format, sub_dir, resample)
+            record(ID, signature, hdf5_path)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(convert_patient, ID, input_path, save_path, annotation_list, target_format, sub_dir, resample):(ID, signature)
+                       for ID, signature in task_list}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                ID, signature = futures[future]
                 try:
-                    reader = Dicom_Reader(series_path, target_format, rt_path, annotation_list,trunc_flag=False, normalize_flag=False)
-                except:
-                    print("Error data: %s" % ID)
+                    hdf5_path = future.result()
+                except Exception as e:
+                    print("Error data: %s, %s" % (ID, e))
                     continue
-                else:
-                    if resample:
-                        images = reader.get_resample_images()
-                        labels = reader.get_resample_labels()
-                    else:
-                        images = reader.get_raw_images()
-                        labels = reader.get_raw_labels()
-                    tmp_images.append(images)
-                    tmp_labels.append(labels)
-        images = np.concatenate(tmp_images,axis=0).astype(np.int16)
-        labels = np.concatenate(tmp_labels,axis=0).astype(np.uint8)
-        hdf5_path = os.path.join(save_path, ID + '.hdf5')
-        print("=================%s done!================="%ID)
-
-        save_as_hdf5(images, hdf5_path, 'image')
-        save_as_hdf5(labels, hdf5_path, 'label')
+                record(ID, signature, hdf5_path)
 
     print("run time: %.3f" % (time.time() - start))
 
@@ -71,5 +190,7 @@ if __name__ == "__main__":
     with open(json_file, 'r') as fp:
         info = json.load(fp)
     # dicom_to_hdf5(info['dicom_path'], info['npy_path'], info['annotation_list'], info['target_format'],sub_dir = ['down','up'],resample=False)
-    dicom_to_hdf5(info['dicom_path'], info['npy_path'], info['annotation_list'], info['target_format'],sub_dir = ['up'],resample=False)
+    dicom_to_hdf5(info['dicom_path'], info['npy_path'], info['annotation_list'], info['target_format'],sub_dir = ['up'],resample=False,num_workers=8)
+    # reconvert the patients whose dicom files changed since the last run
+    # dicom_to_hdf5(info['dicom_path'], info['npy_path'], info['annotation_list'], info['target_format'],sub_dir = ['up'],resample=False,num_workers=8,check='mtime')
     
\ No newline at end of file
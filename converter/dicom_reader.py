@@ -11,6 +11,18 @@ import cv2
 import re
 
 from converter.utils import dicom_series_reader,trunc_gray,normalize,dicom_series_reader_without_postfix
+from data_utils.resample import resize_label
+
+
+def contour_points(contour):
+    '''
+    ContourData of a contour item as a N*3 array.
+    The raw DS string is parsed at once, much faster than the per-value conversion of pydicom.
+    '''
+    element = contour.get_item('ContourData')
+    if isinstance(element.value, bytes):
+        return np.array(element.value.decode().replace('\\', ' ').split(), dtype=np.float64).reshape((-1, 3))
+    return np.array(element.value, dtype=np.float64).reshape((-1, 3))
 
 
 # by pydicom 
@@ -79,7 +91,8 @@ class Dicom_Reader(object):
                 images = self.get_raw_images()
                 images = resize(images,
                                 (info['z_size'], ) + tuple(self.target_format['size']),
-                                mode='constant')
+                                mode='constant',
+                                preserve_range=True)
                 return images
 
 
@@ -90,7 +103,8 @@ class Dicom_Reader(object):
                 images = self.get_denoising_images()
                 images = resize(images,
                                 (info['z_size'], ) + tuple(self.target_format['size']),
-                                mode='constant')
+                                mode='constant',
+                                preserve_range=True)
                 return images
 
 
@@ -115,12 +129,9 @@ class Dicom_Reader(object):
             return self.get_raw_labels()
         else:
             raw_label = self.get_raw_labels()
-            labels = np.zeros((info['z_size'], ) + tuple(self.target_format['size']),dtype=np.float32)
-            for i in range(self.num_class):
-                roi = resize((raw_label == i + 1).astype(np.float32),
-                             (info['z_size'], ) +tuple(self.target_format['size']),
-                             mode='constant')
-                labels[roi >= 0.5] = i + 1
+            labels = resize_label(raw_label,
+                                  (info['z_size'], ) + tuple(self.target_format['size']),
+                                  self.num_class + 1)
             return labels
 
 
@@ -141,7 +152,7 @@ class Dicom_Reader(object):
                 contour_item['name'] = annotation_list[tmp_annotation_list.index(ROIName)]
                 assert contour_item['number'] == structure.StructureSetROISequence[i].ROINumber
                 contour_item['coord_point'] = [
-                    s.ContourData
+                    contour_points(s)
                     for s in structure.ROIContourSequence[i].ContourSequence
                 ]
                 contours[contour_item['name']] = contour_item
@@ -149,7 +160,10 @@ class Dicom_Reader(object):
         return contours
 
     def draw_labels(self, shape, contours, meta_data, annotation_list):
-        z = [np.around(s.ImagePositionPatient[2], 0) for s in meta_data]
+        # rounded z -> first slice at this position
+        z_index_map = {}
+        for i, s in enumerate(meta_data):
+            z_index_map.setdefault(np.around(s.ImagePositionPatient[2], 0), i)
 
         origin = np.array(meta_data[0].ImagePositionPatient[:2])
         spacing = np.array(meta_data[0].PixelSpacing)
@@ -173,22 +187,25 @@ class Dicom_Reader(object):
 
             if 'coord_point' not in con or len(con['coord_point']) == 0:
                 print('There is no point!')
-            for item in con['coord_point']:
-                points = np.array(item).reshape((-1, 3))
-                try:
-                    assert np.amax(np.abs(np.diff(points[:, 2]))) == 0
-                    z_index = z.index(np.around(points[0, 2], 0))
-                except:
+            coord_point = [np.asarray(item, dtype=np.float64).reshape((-1, 3)) for item in con.get('coord_point', [])]
+            points = []
+            if len(coord_point) != 0:
+                # all the points of the ROI to image coordinates in one multiply
+                points = np.concatenate(coord_point, axis=0)
+                points = np.matmul(points[:, :2] - origin, transfmat)
+                points = np.split(points, np.cumsum([len(item) for item in coord_point])[:-1])
+            for item, item_points in zip(coord_point, points):
+                # planar contour on a slice of the series
+                z_index = None
+                if len(item) > 1 and np.ptp(item[:, 2]) == 0:
+                    z_index = z_index_map.get(np.around(item[0, 2], 0))
+                if z_index is None:
                     count +=1
                     print(con['name'])
                     continue
-                points = points[:, :2] - origin
-                points = np.array([
-                    np.matmul(points[i], transfmat) for i in range(points.shape[0])
-                ])
-                r = points[:, 1]
-                c = points[:, 0]
-                rr, cc = polygon(r, c)
+                r = item_points[:, 1]
+                c = item_points[:, 0]
+                rr, cc = polygon(r, c, shape=shape[1:])
                 labels[z_index, rr, cc] = ROI_NUMBER
             if count != 0:
                 print('lack %d slices in %s'%(count,annotation))
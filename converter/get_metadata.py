@@ -1,9 +1,15 @@
 import os
 import glob
 import pandas as pd
+import numpy as np
+import pydicom
 import SimpleITK as sitk
 from tqdm import tqdm
 import json
+from concurrent.futures import ThreadPoolExecutor
+
+# tags needed by metadata_header_reader, the other elements and the pixel data are not parsed
+HEADER_TAGS = ['Rows', 'Columns', 'PixelSpacing', 'SliceThickness', 'ImagePositionPatient']
 
 
 def metadata_reader(data_path):
@@ -23,21 +29,55 @@ def metadata_reader(data_path):
     info.append(pixel_spacing)
     return info
 
-# CT and RT in different folders
-def get_metadata(input_path, save_path):
-
-    id_list = os.listdir(input_path)
+def metadata_header_reader(data_path):
+    '''
+    Same info as metadata_reader from the dicom headers only, without decoding the pixels.
+    The thickness is the mean z distance between the slices, as the z spacing of SimpleITK.
+    '''
     info = []
-    for ID in tqdm(id_list):
-        info_item = [ID]
-        data_path = os.path.join(input_path,ID)
-        sub_dir = ['up','down']
-        for sub in sub_dir:
-            sub_path = os.path.join(data_path,sub)
-            if os.path.exists(sub_path):
-                series_path = glob.glob(os.path.join(sub_path, '*' + ID + '*CT*'))[0]
+    dcms = glob.glob(os.path.join(data_path, '*.dcm'))
+    headers = [pydicom.read_file(dcm, stop_before_pixels=True, specific_tags=HEADER_TAGS, force=True) for dcm in dcms]
+    z_position = np.sort([float(header.ImagePositionPatient[2]) for header in headers])
+    size = [int(headers[0].Columns), int(headers[0].Rows)]
+    z_size = len(headers)
+    if z_size > 1:
+        thick_ness = float((z_position[-1] - z_position[0]) / (z_size - 1))
+    else:
+        thick_ness = float(headers[0].SliceThickness)
+    # PixelSpacing is (row, column), i.e. (y, x)
+    pixel_spacing = [float(headers[0].PixelSpacing[1]), float(headers[0].PixelSpacing[0])]
+    info.append(size)
+    info.append(z_size)
+    info.append(thick_ness)
+    info.append(pixel_spacing)
+    return info
+
+
+def patient_metadata(ID, input_path, header_only=True):
+    info_item = [ID]
+    data_path = os.path.join(input_path,ID)
+    sub_dir = ['up','down']
+    for sub in sub_dir:
+        sub_path = os.path.join(data_path,sub)
+        if os.path.exists(sub_path):
+            series_path = glob.glob(os.path.join(sub_path, '*' + ID + '*CT*'))[0]
+            if header_only:
+                info_item.extend(metadata_header_reader(series_path))
+            else:
                 info_item.extend(metadata_reader(series_path))
-        info.append(info_item)
+    return info_item
+
+
+# CT and RT in different folders
+def get_metadata(input_path, save_path, header_only=True, num_workers=8):
+    '''
+    Args:
+    - header_only: True to read only the needed dicom tags, False to read the series by SimpleITK
+    - num_workers: integer, number of patients read concurrently
+    '''
+    id_list = os.listdir(input_path)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        info = list(tqdm(executor.map(lambda ID: patient_metadata(ID, input_path, header_only), id_list), total=len(id_list)))
     col = ['id'] + ['size', 'num', 'thickness', 'pixel_spacing']*2
 
     info_data = pd.DataFrame(columns=col,data=info)
@@ -8,8 +8,10 @@ import shutil
 import h5py
 from skimage.transform import resize
 import json
+import pandas as pd
 
 from converter.utils import hdf5_reader
+from data_utils.resample import resize_label
 
 
 def store_images_labels(save_path, patient_id, images, labels, mode):
@@ -29,6 +31,48 @@ def store_images_labels(save_path, patient_id, images, labels, mode):
         hdf5_file.create_dataset('label', data=labels.astype(np.uint8))
         hdf5_file.close()
 
+    # all slices of one patient in a single file, chunked by slice
+    elif mode == 'packed':
+        chunks = (1, ) + images.shape[1:]
+        hdf5_file = h5py.File(os.path.join(save_path, patient_id + '.hdf5'),'w')
+        hdf5_file.create_dataset('image', data=images.astype(np.int16), chunks=chunks)
+        hdf5_file.create_dataset('label', data=labels.astype(np.uint8), chunks=chunks)
+        hdf5_file.close()
+
+
+def store_slice_index(save_path, index_info, name='index.csv'):
+    '''
+    Save the (patient, slice) -> (file, offset) index of a packed slice store.
+    The id column keeps the name of the slice in '2d' mode, i.e. patientID_sliceIndex.
+    '''
+    col = ['id', 'patient', 'path', 'offset']
+    csv_file = pd.DataFrame(columns=col, data=index_info)
+    csv_file.to_csv(os.path.join(save_path, name), index=False)
+
+
+def build_volume_index(input_path, for_training=True, retain=10):
+    '''
+    Index the slices of the per-patient volumes written by converter.dicom2npy, without copying them,
+    for VolumeSliceGenerator (or DataGenerator with index_path). Only the dataset shapes are read.
+    The patients are split as prepare_data, the index is saved as input_path/index.csv for training
+    and input_path/test_index.csv for the retained test patients.
+    '''
+    path_list = [item for item in os.listdir(input_path) if item.endswith('.hdf5')]
+    if for_training:
+        path_list = path_list[:-retain]
+    else:
+        path_list = path_list[-retain:]
+
+    index_info = []
+    for item in tqdm(path_list):
+        ID, _ = os.path.splitext(item)
+        data_path = os.path.join(input_path, item)
+        with h5py.File(data_path, 'r') as hdf5_file:
+            depth = hdf5_file['image'].shape[0]
+        index_info.extend([['%s_%d' % (ID, i), ID, data_path, i] for i in range(depth)])
+
+    store_slice_index(input_path, index_info, 'index.csv' if for_training else 'test_index.csv')
+
 
 def prepare_data(input_path, save_path, data_shape, crop=0, mode='2d',for_training=True,retain=10):
 
@@ -38,7 +82,9 @@ def prepare_data(input_path, save_path, data_shape, crop=0, mode='2d',for_traini
     #     shutil.rmtree(save_path)
     #     os.makedirs(save_path)
 
-    path_list = os.listdir(input_path)
+    # skip the manifest and the indexes of the volume store
+    path_list = [item for item in os.listdir(input_path) if item.endswith('.hdf5')]
+    index_info = []
     start = time.time()
     # keep 10 samples as final test set
     if for_training:
@@ -57,25 +103,84 @@ def prepare_data(input_path, save_path, data_shape, crop=0, mode='2d',for_traini
             images = images[:,crop:-crop,crop:-crop]
             labels = labels[:,crop:-crop,crop:-crop]
         
-        class_list = list(np.unique(labels).astype(np.uint8))
         target_shape = data_shape
-        if mode == '2d':
+        if mode in ['2d', 'packed']:
             target_shape = (images.shape[0], ) + data_shape
 
         if images.shape != target_shape:
             images = resize(images, target_shape, mode='constant')
-            tmp_labels = np.zeros(target_shape, dtype=np.float32)
-            for z in class_list:
-                if z != 0:
-                    roi = resize((labels == z).astype(np.float32),
-                                target_shape,
-                                mode='constant')
-                    tmp_labels[roi >= 0.5] = z
-            labels = tmp_labels
+            labels = resize_label(labels, target_shape)
 
         store_images_labels(save_path, ID, images, labels, mode)
+        if mode == 'packed':
+            hdf5_path = os.path.join(save_path, ID + '.hdf5')
+            index_info.extend([['%s_%d' % (ID, i), ID, hdf5_path, i] for i in range(images.shape[0])])
+
+    if mode == 'packed':
+        store_slice_index(save_path, index_info)
     print("run time: %.3f" % (time.time() - start))
 
+def build_memmap_cache(path_list, save_path, data_shape, scale, crop=0, index_path=None):
+    '''
+    Write 2d slices into raw .npy memmaps in the stored dtypes (image: int16, label: uint8),
+    cropped, truncated to scale and resized to data_shape, for DataGenerator(mmap_path=save_path).
+    The image is truncated before the resize as in Trunc_and_Normalize + CropResize, the normalization is left to the trainer.
+    The settings are saved in meta.json and checked by the trainer.
+    Args:
+    - path_list: list of slice hdf5 path, or list of slice id if index_path is given
+    - save_path: string, output directory of image.npy, label.npy, index.csv and meta.json
+    - data_shape: tuple of integer, slice shape in the cache, should be the input shape of the net
+    - scale: list of integer, gray scale range, same as the scale of the trainer
+    - crop: integer, cropping size
+    - index_path: string or None, index of the packed slice store
+    '''
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+    if index_path is not None:
+        index_df = pd.read_csv(index_path, dtype={'id':str,'patient':str})
+        slice_index = dict(zip(index_df['id'], zip(index_df['path'], index_df['offset'])))
+
+    data_shape = tuple(data_shape)
+    cache_shape = (len(path_list), ) + data_shape
+    image_cache = np.lib.format.open_memmap(os.path.join(save_path, 'image.npy'), mode='w+', dtype=np.int16, shape=cache_shape)
+    label_cache = np.lib.format.open_memmap(os.path.join(save_path, 'label.npy'), mode='w+', dtype=np.uint8, shape=cache_shape)
+
+    index_info = []
+    start = time.time()
+    for i, item in enumerate(tqdm(path_list)):
+        if index_path is not None:
+            ID = item
+            data_path, offset = slice_index[item]
+            hdf5_file = h5py.File(data_path, 'r')
+            image = np.asarray(hdf5_file['image'][offset], dtype=np.float32)
+            label = np.asarray(hdf5_file['label'][offset], dtype=np.float32)
+            hdf5_file.close()
+        else:
+            ID, _ = os.path.splitext(os.path.basename(item))
+            image = hdf5_reader(item, 'image')
+            label = hdf5_reader(item, 'label')
+
+        if crop != 0:
+            image = image[crop:-crop,crop:-crop]
+            label = label[crop:-crop,crop:-crop]
+
+        image = np.clip(np.asarray(image, dtype=np.float32), scale[0], scale[1])
+        if image.shape != data_shape:
+            image = resize(image, data_shape, anti_aliasing=True, preserve_range=True)
+            label = resize_label(label, data_shape)
+
+        image_cache[i] = np.rint(image).astype(np.int16)
+        label_cache[i] = label.astype(np.uint8)
+        index_info.append([ID, ID.split('_')[0], save_path, i])
+
+    image_cache.flush()
+    label_cache.flush()
+    store_slice_index(save_path, index_info)
+    with open(os.path.join(save_path, 'meta.json'), 'w') as fp:
+        json.dump({'shape':list(data_shape), 'crop':crop, 'scale':list(scale)}, fp)
+    print("run time: %.3f" % (time.time() - start))
+
+
 if __name__ == "__main__":
     # json_file = './static_files/TMLI_config.json'
     # json_file = './static_files/TMLI_config_up.json'
@@ -86,5 +191,14 @@ if __name__ == "__main__":
         setting_2d = info['2d_data']
         setting_3d = info['3d_data']
     # prepare_data(input_path, setting_2d['train_path'], tuple(setting_2d['shape']), setting_2d['crop'],mode='2d')
+    # index the volumes in place, instead of the 2d copy
+    # build_volume_index(input_path)
+    # build_volume_index(input_path,for_training=False)
     prepare_data(input_path, setting_2d['test_path'], tuple(setting_2d['shape']), setting_2d['crop'],mode='2d',for_training=False)
+    # setting_packed = info['packed_data']
+    # prepare_data(input_path, setting_packed['train_path'], tuple(setting_packed['shape']), setting_packed['crop'],mode='packed')
+    # setting_mmap = info['mmap_data']
+    # import glob
+    # train_list = glob.glob(os.path.join(setting_2d['train_path'],'*.hdf5'))
+    # build_memmap_cache(train_list, setting_mmap['train_path'], tuple(setting_mmap['shape']), info['scale']['All'], setting_mmap['crop'])
     # prepare_data(input_path, setting_3d['train_path'], tuple(setting_3d['shape']), setting_3d['crop'],mode='3d')
\ No newline at end of file
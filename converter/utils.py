@@ -5,6 +5,7 @@ import SimpleITK as sitk
 import glob
 import os
 import pydicom
+from concurrent.futures import ThreadPoolExecutor
 
 
 
@@ -22,6 +23,25 @@ def save_as_hdf5(data, save_path, key):
     hdf5_file.close()
 
 
+def append_as_hdf5(data, save_path, key, compression='lzf'):
+    '''
+    Append a volume (D*H*W) to the dataset key along the first axis, the dataset is created on the first call.
+    The dataset is chunked by slice (1,H,W), so that a slice is read by decompressing a single chunk.
+    Args:
+    - compression: string or None, hdf5 filter, 'lzf' is fast and always available in h5py
+    '''
+    hdf5_file = h5py.File(save_path, 'a')
+    if key not in hdf5_file:
+        hdf5_file.create_dataset(key, data=data, maxshape=(None, ) + data.shape[1:],
+                                 chunks=(1, ) + data.shape[1:], compression=compression)
+    else:
+        dataset = hdf5_file[key]
+        start = dataset.shape[0]
+        dataset.resize(start + data.shape[0], axis=0)
+        dataset[start:] = data
+    hdf5_file.close()
+
+
 def save_as_nii(data, save_path):
     sitk_data = sitk.GetImageFromArray(data)
     sitk.WriteImage(sitk_data, save_path)
@@ -48,39 +68,51 @@ e.g. one sample consist of 214 slices
 '''
 
 
-## dicom series reader by pydicom, rt and series in different folders
-def dicom_series_reader(data_path):
-    dcms = glob.glob(os.path.join(data_path, '*.dcm'))
+def _read_dicom(dcm):
+    # fall back to force=True for this file only
     try:
-        meta_data = [pydicom.read_file(dcm) for dcm in dcms]
+        return pydicom.read_file(dcm)
     except:
-        meta_data = [pydicom.read_file(dcm,force=True) for dcm in dcms]
-        for i in range(len(meta_data)):
-            meta_data[i].file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
-    meta_data.sort(key=lambda x: float(x.ImagePositionPatient[2]))
-    images = np.stack([s.pixel_array for s in meta_data],axis=0).astype(np.float32)
-    # pixel value transform to HU
+        meta_data = pydicom.read_file(dcm,force=True)
+        meta_data.file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
+        return meta_data
+
+
+def read_dicom_series(dcms, num_workers=8):
+    '''
+    Read the dicom files of a series in a thread pool (file reads and pixel decoding release the GIL).
+    The slices are sorted by z position and written into a preallocated volume in HU,
+    int16 when the rescale is an integer shift (always for CT), float32 otherwise.
+    Return the sorted meta data and the volume.
+    '''
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        meta_data = list(executor.map(_read_dicom, dcms))
+        meta_data.sort(key=lambda x: float(x.ImagePositionPatient[2]))
+
+        # pixel value transform to HU
+        slope = float(meta_data[0].RescaleSlope)
+        intercept = float(meta_data[0].RescaleIntercept)
+        dtype = np.int16 if slope == 1 and intercept.is_integer() else np.float32
+        images = np.empty((len(meta_data), meta_data[0].Rows, meta_data[0].Columns), dtype=dtype)
+
+        def fill(i):
+            images[i] = meta_data[i].pixel_array * slope + intercept
+        list(executor.map(fill, range(len(meta_data))))
     # images [images == -2000] = 0
-    images = images * meta_data[0].RescaleSlope + meta_data[0].RescaleIntercept
     return meta_data, images
 
 
+## dicom series reader by pydicom, rt and series in different folders
+def dicom_series_reader(data_path, num_workers=8):
+    dcms = glob.glob(os.path.join(data_path, '*.dcm'))
+    return read_dicom_series(dcms, num_workers)
+
+
 ## dicom series reader by pydicom
-def dicom_series_reader_without_postfix(data_path):
+def dicom_series_reader_without_postfix(data_path, num_workers=8):
     dcms = glob.glob(os.path.join(data_path, 'CT*'))
     dcms = [dcm for dcm in dcms if "dir" not in dcm]
-    try:
-        meta_data = [pydicom.read_file(dcm) for dcm in dcms]
-    except:
-        meta_data = [pydicom.read_file(dcm,force=True) for dcm in dcms]
-        for i in range(len(meta_data)):
-            meta_data[i].file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
-    meta_data.sort(key=lambda x: float(x.ImagePositionPatient[2]))
-    images = np.stack([s.pixel_array for s in meta_data],axis=0).astype(np.float32)
-    # pixel value transform to HU
-    # images [images == -2000] = 0
-    images = images * meta_data[0].RescaleSlope + meta_data[0].RescaleIntercept
-    return meta_data, images
+    return read_dicom_series(dcms, num_workers)
 
 
 ## nii.gz reader
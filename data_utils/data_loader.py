@@ -1,10 +1,14 @@
 import sys
 sys.path.append('..')
+import os
+import json
+import hashlib
 
 from torch.utils.data import Dataset
 import torch
 import numpy as np
-from utils import hdf5_reader
+from utils import HDF5Pool, SliceCache, SliceCatalog, get_slice_index, get_slice_tags, get_slice_id
+from data_utils.resample import resize_label
 from skimage.transform import resize
 import cv2
 from scipy.ndimage.interpolation import map_coordinates
@@ -49,6 +53,20 @@ class CropResize(object):
         self.num_class = num_class
         self.crop = crop
 
+    def _crop(self, array):
+        if len(array.shape) > 2:
+            return array[:,self.crop:-self.crop, self.crop:-self.crop]
+        else:
+            return array[self.crop:-self.crop, self.crop:-self.crop]
+
+    def _resize(self, image, mask):
+        if self.dim is not None and mask.shape != tuple(self.dim):
+            # the context slices of a 2.5d stack (C,H,W) are resized channel by channel
+            image_dim = tuple(self.dim) if image.ndim == mask.ndim else image.shape[:1] + tuple(self.dim)
+            image = resize(image, image_dim, anti_aliasing=True)
+            mask = resize_label(mask, self.dim, self.num_class)
+        return image, mask
+
     def __call__(self, sample):
 
         # image: numpy array
@@ -57,34 +75,94 @@ class CropResize(object):
         mask = sample['mask']
         # crop
         if self.crop != 0:
-            if len(image.shape) > 2:
-                image = image[:,self.crop:-self.crop, self.crop:-self.crop]
-                mask = mask[:,self.crop:-self.crop, self.crop:-self.crop]
-            else:
-                image = image[self.crop:-self.crop, self.crop:-self.crop]
-                mask = mask[self.crop:-self.crop, self.crop:-self.crop]
+            image = self._crop(image)
+            mask = self._crop(mask)
         # resize
-        if self.dim is not None and image.shape != self.dim:
-            image = resize(image, self.dim, anti_aliasing=True)
-            temp_mask = np.zeros(self.dim,dtype=np.float32)
-            for z in range(1, self.num_class):
-                roi = resize((mask == z).astype(np.float32),self.dim,mode='constant')
-                temp_mask[roi >= 0.5] = z
-            mask = temp_mask
+        image, mask = self._resize(image, mask)
 
         new_sample = {'image': image, 'mask': mask}
 
         return new_sample
 
 
+class Trunc_Norm_CropResize(CropResize):
+    '''
+    Deterministic preprocessing, Trunc_and_Normalize followed by CropResize in one pass.
+    The crop is taken first (it commutes with the truncation) and the gray truncation
+    is done in one clip on the cropped array.
+    Args:
+    - scale: gray scale range
+    - dim, num_class, crop: same as CropResize
+    '''
+    def __init__(self, scale, dim=None, num_class=2, crop=0):
+        super(Trunc_Norm_CropResize, self).__init__(dim, num_class, crop)
+        self.scale = scale
+        assert len(self.scale) == 2, 'scale error'
+
+    def __call__(self, sample):
+        image = sample['image']
+        mask = sample['mask']
+        if self.crop != 0:
+            image = self._crop(image)
+            mask = self._crop(mask)
+
+        # gray truncation and normalization
+        gray_range = self.scale[1] - self.scale[0]
+        image = np.clip(image - self.scale[0], 0, gray_range)
+        image /= gray_range
+
+        image, mask = self._resize(image, mask)
+
+        return {'image': image, 'mask': mask}
+
+
+class PreprocessCache(object):
+    '''
+    On-disk cache of the deterministic preprocessing (Trunc_Norm_CropResize) result of each slice,
+    keyed by (path, scale, input_shape, crop, roi_number). Put cache_dir under /dev/shm to keep it in shared memory.
+    Args:
+    - cache_dir: string, directory of the cached .npz files
+    - scale, dim, num_class, crop: same as Trunc_Norm_CropResize
+    - roi_number: integer or None, same as DataGenerator
+    '''
+    def __init__(self, cache_dir, scale, dim=None, num_class=2, crop=0, roi_number=None):
+        self.cache_dir = cache_dir
+        self.preprocess = Trunc_Norm_CropResize(scale, dim, num_class, crop)
+        self.setting = (tuple(scale), tuple(dim) if dim is not None else None, crop, roi_number)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _get_cache_path(self, key):
+        name = hashlib.md5(repr((key, ) + self.setting).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, name + '.npz')
+
+    def load(self, key):
+        cache_path = self._get_cache_path(key)
+        if not os.path.exists(cache_path):
+            return None
+        with np.load(cache_path) as data:
+            return {'image': data['image'], 'mask': data['mask']}
+
+    def save(self, key, sample):
+        cache_path = self._get_cache_path(key)
+        # write then rename, workers may preprocess the same slice at the same time
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        with open(tmp_path, 'wb') as fp:
+            np.savez(fp, image=sample['image'].astype(np.float32), mask=sample['mask'].astype(np.uint8))
+        os.replace(tmp_path, cache_path)
+
+
 class To_Tensor(object):
     '''
     Convert the data in sample to torch Tensor.
     Args:
     - n_class: the number of class
+    - one_hot: True to encode the mask as float one-hot (C,H,W),
+               False to keep the uint8 label map (H,W) which is expanded on device
     '''
-    def __init__(self, num_class=2):
+    def __init__(self, num_class=2, one_hot=True):
         self.num_class = num_class
+        self.one_hot = one_hot
 
     def __call__(self, sample):
 
@@ -92,7 +170,14 @@ class To_Tensor(object):
         mask = sample['mask']
         # expand dims
 
-        new_image = np.expand_dims(image, axis=0)
+        # the 2.5d stack has its channel axis already
+        new_image = np.expand_dims(image, axis=0) if image.ndim == mask.ndim else image
+        if not self.one_hot:
+            return {
+                'image': torch.from_numpy(new_image),
+                'mask': torch.from_numpy(mask.astype(np.uint8))
+            }
+
         new_mask = np.empty((self.num_class, ) + mask.shape, dtype=np.float32)
         for z in range(1,self.num_class):
             temp = (mask == z).astype(np.float32)
@@ -107,6 +192,28 @@ class To_Tensor(object):
         return new_sample
 
 
+def check_memmap_cache(mmap_path, shape, crop, scale):
+    '''
+    Check that the memmap cache was built with the preprocessing settings of the trainer,
+    the cached slices skip Trunc_and_Normalize and CropResize.
+    Args:
+    - mmap_path: string, directory of the memmap cache
+    - shape: tuple of integer, input shape of the net
+    - crop: integer, cropping size
+    - scale: list of integer, gray scale range
+    '''
+    cache_shape = np.load(os.path.join(mmap_path, 'image.npy'), mmap_mode='r').shape[1:]
+    if tuple(cache_shape) != tuple(shape):
+        raise ValueError('memmap cache shape %s does not match input_shape %s' % (tuple(cache_shape), tuple(shape)))
+    meta_path = os.path.join(mmap_path, 'meta.json')
+    if not os.path.exists(meta_path):
+        raise ValueError('%s not found, rebuild the memmap cache with build_memmap_cache' % meta_path)
+    with open(meta_path, 'r') as fp:
+        meta = json.load(fp)
+    if meta['crop'] != crop or list(meta['scale']) != list(scale):
+        raise ValueError('memmap cache built with crop=%s, scale=%s, the trainer uses crop=%s, scale=%s' % (meta['crop'], meta['scale'], crop, list(scale)))
+
+
 class DataGenerator(Dataset):
     '''
     Custom Dataset class for data loader.
@@ -115,39 +222,284 @@ class DataGenerator(Dataset):
     - roi_number: integer or None, to extract the corresponding label
     - num_class: the number of classes of the label
     - transform: the data augmentation methods
+    - index_path: string or None, index of the packed slice store, path_list is a list of slice id if given
+    - pool_size: integer, max number of hdf5 files kept open by each worker
+    - mmap_path: string or None, directory of the memmap cache built by converter.prepare_data.build_memmap_cache.
+                 If given, path_list is a list of slice id, the transform is skipped and the raw int16 image (1,H,W)
+                 and uint8 mask (H,W) are returned, the trainer normalizes them and encodes the one-hot mask on device.
+    - preprocess_cache: PreprocessCache or None, the deterministic preprocessing is read from the cache
+                 (computed and saved on a miss) before the transform
+    - catalog_path: string or None, slice catalog built by converter.csv_maker.build_catalog,
+                 the label (class presence of the slice) is looked up instead of computed from the mask
     '''
     def __init__(self,
                  path_list=None,
                  roi_number=None,
                  num_class=2,
-                 transform=None):
+                 transform=None,
+                 index_path=None,
+                 pool_size=32,
+                 mmap_path=None,
+                 preprocess_cache=None,
+                 catalog_path=None):
 
         self.path_list = path_list
         self.roi_number = roi_number
         self.num_class = num_class
         self.transform = transform
+        self.mmap_path = mmap_path
+        self.preprocess_cache = preprocess_cache
+        if mmap_path is not None:
+            index_path = os.path.join(mmap_path, 'index.csv')
+        self.slice_index = get_slice_index(index_path) if index_path is not None else None
+        self.catalog = SliceCatalog(catalog_path) if catalog_path is not None else None
+        # opened lazily in each worker
+        self.hdf5_pool = HDF5Pool(pool_size)
+        self.image_cache = None
+        self.label_cache = None
 
 
     def __len__(self):
         return len(self.path_list)
 
-    def __getitem__(self, index):
-        # Get image and mask
-        image = hdf5_reader(self.path_list[index],'image')
-        mask = hdf5_reader(self.path_list[index],'label')
+    def _get_raw_item(self, index):
+        if self.image_cache is None:
+            self.image_cache = np.load(os.path.join(self.mmap_path, 'image.npy'), mmap_mode='r')
+            self.label_cache = np.load(os.path.join(self.mmap_path, 'label.npy'), mmap_mode='r')
+        _, offset = self.slice_index[self.path_list[index]]
+        image = np.array(self.image_cache[offset])
+        mask = np.array(self.label_cache[offset])
 
         if self.roi_number is not None:
             assert self.num_class == 2
-            mask = (mask == self.roi_number).astype(np.float32)
+            mask = (mask == self.roi_number).astype(np.uint8)
 
-        sample = {'image': image, 'mask': mask}
-        if self.transform is not None:
-            sample = self.transform(sample)
+        if self.catalog is not None:
+            label = self.catalog.get_label(self.path_list[index], self.roi_number)
+        else:
+            label = np.zeros((self.num_class, ), dtype=np.float32)
+            label[np.unique(mask)] = 1
+            label = label[1:]
+
+        sample = {
+            'image': torch.from_numpy(image[None]),
+            'mask': torch.from_numpy(mask),
+            'label': torch.from_numpy(label)
+        }
+
+        return sample
+
+    def _read_sample(self, index):
+        # Get image and mask
+        if self.slice_index is not None:
+            data_path, offset = self.slice_index[self.path_list[index]]
+        else:
+            data_path, offset = self.path_list[index], None
+
+        sample = None
+        if self.preprocess_cache is not None:
+            sample = self.preprocess_cache.load((data_path, offset))
 
+        if sample is None:
+            image, mask = self.hdf5_pool.read(data_path,['image','label'],offset)
+
+            if self.roi_number is not None:
+                assert self.num_class == 2
+                mask = (mask == self.roi_number).astype(np.float32)
+
+            sample = {'image': image, 'mask': mask}
+            if self.preprocess_cache is not None:
+                sample = self.preprocess_cache.preprocess(sample)
+                self.preprocess_cache.save((data_path, offset), sample)
+
+        return sample
+
+    def _add_label(self, sample):
         label = np.zeros((self.num_class, ), dtype=np.float32)
-        label_array = np.argmax(sample['mask'].numpy(),axis=0)
+        if sample['mask'].dim() < sample['image'].dim():
+            label_array = sample['mask'].numpy()
+        else:
+            label_array = np.argmax(sample['mask'].numpy(),axis=0)
         label[np.unique(label_array).astype(np.uint8)] = 1
 
         sample['label'] = torch.Tensor(list(label[1:]))
 
         return sample
+
+    def __getitem__(self, index):
+        if self.mmap_path is not None:
+            return self._get_raw_item(index)
+
+        sample = self._read_sample(index)
+        if self.transform is not None:
+            sample = self.transform(sample)
+
+        if self.catalog is not None:
+            sample['label'] = torch.from_numpy(self.catalog.get_label(self.path_list[index], self.roi_number))
+            return sample
+        return self._add_label(sample)
+
+
+class PatchGenerator(DataGenerator):
+    '''
+    Dataset of fixed-size patches drawn from the full-resolution slices, for patch-based training.
+    With probability fg_prob the patch is centered (with a random jitter) on a voxel of a foreground class,
+    the class is drawn among the classes tagged for the slice in the csv_maker table,
+    weighted by class_weight (inverse tag frequency by default), so that rare structures are oversampled.
+    Otherwise the patch is drawn uniformly.
+    Args:
+    - patch_size: tuple of integer, (H,W) of the patch
+    - tag_csv_path: string, per-slice class tags made by converter.csv_maker
+    - fg_prob: float, probability of a foreground-centered patch
+    - class_weight: list of float or None, sampling weight of each foreground class
+    - crop: integer, cropping size of the full slice before the patch is drawn,
+            the transform should not crop the patch again
+    - others are same as DataGenerator, mmap_path is not supported
+    '''
+    def __init__(self,
+                 path_list=None,
+                 roi_number=None,
+                 num_class=2,
+                 transform=None,
+                 index_path=None,
+                 pool_size=32,
+                 patch_size=(256,256),
+                 tag_csv_path=None,
+                 fg_prob=0.7,
+                 class_weight=None,
+                 crop=0):
+        super(PatchGenerator, self).__init__(path_list, roi_number, num_class, transform, index_path, pool_size)
+        self.patch_size = tuple(patch_size)
+        self.fg_prob = fg_prob
+        self.crop = crop
+
+        slice_tags = get_slice_tags(tag_csv_path)
+        tag_matrix = np.stack([slice_tags[get_slice_id(case)] for case in path_list], axis=0) #N*(C-1)
+        if roi_number is not None:
+            tag_matrix = tag_matrix[:, [roi_number - 1]]
+        self.tag_matrix = tag_matrix.astype(bool)
+
+        if class_weight is None:
+            class_weight = 1.0 / np.maximum(np.sum(self.tag_matrix, axis=0), 1)
+        self.class_weight = np.asarray(class_weight, dtype=np.float64)
+
+    def _get_start(self, center, size, patch):
+        # random position of the center inside the patch
+        start = center - np.random.randint(0, patch)
+        return int(np.clip(start, 0, size - patch))
+
+    def _crop_patch(self, index, sample):
+        image = sample['image']
+        mask = sample['mask']
+        if self.crop != 0:
+            image = image[self.crop:-self.crop, self.crop:-self.crop]
+            mask = mask[self.crop:-self.crop, self.crop:-self.crop]
+        ph, pw = self.patch_size
+        # pad the slice smaller than the patch
+        pad_h, pad_w = max(ph - image.shape[0], 0), max(pw - image.shape[1], 0)
+        if pad_h > 0 or pad_w > 0:
+            image = np.pad(image, ((0, pad_h), (0, pad_w)), 'constant', constant_values=np.min(image))
+            mask = np.pad(mask, ((0, pad_h), (0, pad_w)), 'constant')
+        h, w = image.shape
+
+        tags = self.tag_matrix[index]
+        if np.any(tags) and np.random.uniform(0, 1) < self.fg_prob:
+            weight = self.class_weight * tags
+            roi = np.random.choice(len(weight), p=weight / np.sum(weight)) + 1
+            coords = np.argwhere(mask == roi)
+            if len(coords) == 0:
+                coords = np.argwhere(mask != 0)
+        else:
+            coords = []
+
+        if len(coords) != 0:
+            y, x = coords[np.random.randint(len(coords))]
+            top, left = self._get_start(y, h, ph), self._get_start(x, w, pw)
+        else:
+            top, left = np.random.randint(0, h - ph + 1), np.random.randint(0, w - pw + 1)
+
+        return {'image': image[top:top + ph, left:left + pw], 'mask': mask[top:top + ph, left:left + pw]}
+
+    def __getitem__(self, index):
+        sample = self._read_sample(index)
+        sample = self._crop_patch(index, sample)
+        if self.transform is not None:
+            sample = self.transform(sample)
+
+        return self._add_label(sample)
+
+
+class VolumeSliceGenerator(DataGenerator):
+    '''
+    Dataset of the 2d slices read directly from the per-patient volumes written by converter.dicom2npy,
+    indexed by (patient, z) with the index built by converter.prepare_data.build_volume_index.
+    The crop and resize are done lazily by the transform, cached on disk if preprocess_cache is given.
+    With context > 0 the image is a 2.5d stack (2*context+1,H,W) of the neighbouring slices,
+    the slices out of the volume are replaced by the nearest one, the mask is the center slice.
+    The decoded slices are kept in a per-worker LRU cache, the missing slices of a stack are read at once,
+    use a sequential or patient-grouped sampler (data_utils.sampler.PatientGroupedSampler) to reuse them.
+    Args:
+    - index_path: string, index of the volume store (or of the packed store), path_list is a list of slice id
+    - context: integer, number of neighbouring slices on each side
+    - slice_cache_size: integer, max number of slices cached by each worker, 0 to disable
+    - others are same as DataGenerator, mmap_path is not supported
+    '''
+    def __init__(self,
+                 path_list=None,
+                 roi_number=None,
+                 num_class=2,
+                 transform=None,
+                 index_path=None,
+                 pool_size=32,
+                 preprocess_cache=None,
+                 catalog_path=None,
+                 context=0,
+                 slice_cache_size=64):
+        super(VolumeSliceGenerator, self).__init__(path_list, roi_number, num_class, transform, index_path, pool_size,
+                                                   preprocess_cache=preprocess_cache, catalog_path=catalog_path)
+        self.context = context
+        self.slice_cache = SliceCache(slice_cache_size)
+        # slice number of each volume
+        self.depth = {}
+        for data_path, offset in self.slice_index.values():
+            self.depth[data_path] = max(self.depth.get(data_path, 0), offset + 1)
+
+    def _read_stack(self, data_path, offset):
+        # the edge slices are repeated
+        stack_index = np.clip(np.arange(offset - self.context, offset + self.context + 1), 0, self.depth[data_path] - 1)
+        stack = {z:self.slice_cache.get((data_path, z)) for z in set(stack_index.tolist())}
+        missing = [z for z in stack if stack[z] is None]
+        if len(missing) != 0:
+            # one contiguous read of the missing slices
+            start, end = min(missing), max(missing) + 1
+            image = self.hdf5_pool.read(data_path, ['image'], slice(start, end))[0]
+            for z in missing:
+                stack[z] = image[z - start]
+                self.slice_cache.put((data_path, z), stack[z])
+        mask = self.hdf5_pool.read(data_path, ['label'], offset)[0]
+        return np.stack([stack[z] for z in stack_index], axis=0), mask
+
+    def _read_sample(self, index):
+        if self.context == 0:
+            return super(VolumeSliceGenerator, self)._read_sample(index)
+
+        data_path, offset = self.slice_index[self.path_list[index]]
+        key = (data_path, offset, self.context)
+
+        sample = None
+        if self.preprocess_cache is not None:
+            sample = self.preprocess_cache.load(key)
+
+        if sample is None:
+            image, mask = self._read_stack(data_path, offset)
+
+            if self.roi_number is not None:
+                assert self.num_class == 2
+                mask = (mask == self.roi_number).astype(np.float32)
+
+            sample = {'image': image, 'mask': mask}
+            if self.preprocess_cache is not None:
+                sample = self.preprocess_cache.preprocess(sample)
+                self.preprocess_cache.save(key, sample)
+
+        return sample
@@ -0,0 +1,217 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+'''
+Batched data augmentation on device.
+Each transform takes and returns (image, mask):
+- image: float tensor, N*C*H*W
+- mask: label map, N*H*W
+The random parameters are drawn per sample, masks are always resampled with nearest interpolation.
+'''
+
+
+def _grid_sample(image, mask, grid):
+    image = F.grid_sample(image, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+    mask = F.grid_sample(mask[:,None].float(), grid, mode='nearest', padding_mode='zeros', align_corners=False)
+    return image, mask[:,0].to(torch.uint8)
+
+
+def _gaussian_kernel(sigma, device):
+    size = int(4 * sigma) | 1
+    x = torch.arange(size, dtype=torch.float32, device=device) - size // 2
+    kernel = torch.exp(-x**2 / (2 * sigma**2))
+    return kernel / kernel.sum()
+
+
+class BatchCompose(object):
+    '''
+    Compose the batched transforms.
+    Args:
+    - transforms: list of batched transforms
+    '''
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, image, mask):
+        for t in self.transforms:
+            image, mask = t(image, mask)
+        return image, mask
+
+
+class BatchRandomErase2D(object):
+    '''
+    Batched version of RandomErase2D.
+    Erase the image on one side (top, down, left or right) outside the bounding box of the foreground.
+    Args:
+    - window_size: tuple of integer, margin around the foreground
+    - scale_flag: True to scale the margin randomly by [0.5,1)
+    - prob: the erasing is applied if a uniform draw is larger than prob
+    '''
+    def __init__(self, window_size=(64,64), scale_flag=True, prob=0.5):
+        self.window_size = window_size
+        self.scale_flag = scale_flag
+        self.prob = prob
+
+    def __call__(self, image, mask):
+        n, _, h, w = image.size()
+        device = image.device
+        max_h = torch.full((n,), self.window_size[0], device=device)
+        max_w = torch.full((n,), self.window_size[1], device=device)
+        if self.scale_flag:
+            max_h = (max_h * torch.empty(n, device=device).uniform_(0.5, 1)).long()
+            max_w = (max_w * torch.empty(n, device=device).uniform_(0.5, 1)).long()
+
+        fg = mask != 0
+        rows = fg.any(dim=2) # N*H
+        cols = fg.any(dim=1) # N*W
+        has_fg = rows.any(dim=1)
+        row_index = torch.arange(h, device=device)
+        col_index = torch.arange(w, device=device)
+
+        # bounding box of the foreground extended by half a window
+        top = torch.where(rows, row_index, h).min(dim=1)[0] - max_h // 2
+        down = torch.where(rows, row_index, -1).max(dim=1)[0] + max_h // 2
+        left = torch.where(cols, col_index, w).min(dim=1)[0] - max_w // 2
+        right = torch.where(cols, col_index, -1).max(dim=1)[0] + max_w // 2
+        # random window without foreground
+        top = torch.where(has_fg, top.clamp(min=0), torch.randint(0, 65, (n,), device=device))
+        down = torch.where(has_fg, down.clamp(max=h), h + torch.randint(-64, 1, (n,), device=device))
+        left = torch.where(has_fg, left.clamp(min=0), torch.randint(0, 65, (n,), device=device))
+        right = torch.where(has_fg, right.clamp(max=w), w + torch.randint(-64, 1, (n,), device=device))
+
+        apply = torch.rand(n, device=device) > self.prob
+        direction = torch.randint(0, 4, (n,), device=device)
+        row_index = row_index.view(1, h, 1)
+        col_index = col_index.view(1, 1, w)
+        erase = ((direction == 0).view(n,1,1) & (row_index < top.view(n,1,1))) | \
+                ((direction == 1).view(n,1,1) & (row_index >= down.view(n,1,1))) | \
+                ((direction == 2).view(n,1,1) & (col_index < left.view(n,1,1))) | \
+                ((direction == 3).view(n,1,1) & (col_index >= right.view(n,1,1)))
+        erase = erase & apply.view(n,1,1)
+        image = image.masked_fill(erase[:,None], 0)
+
+        return image, mask
+
+
+class BatchRandomAffine2D(object):
+    '''
+    Batched version of RandomAffine2D, zoom, rotation, flipping and translation in a single resampling.
+    Args:
+    - scale: tuple of float, the zoom factor range, < 1 for zooming in as RandomAffine2D
+    - degree: list of rotation degree to choose from
+    - mode: string, consisting of 'h' and 'v', the flipping direction, '' for no flipping
+    - translate: the max shift, in the fraction of the image size
+    '''
+    def __init__(self, scale=(0.8,1.2), degree=[-15,-10,-5,0,5,10,15], mode='v', translate=0.05):
+        self.scale = scale
+        self.degree = degree
+        self.mode = mode
+        self.translate = translate
+
+    def __call__(self, image, mask):
+        n = image.size(0)
+        device = image.device
+
+        zoom = torch.empty(n, device=device).uniform_(self.scale[0], self.scale[1])
+        degree = torch.tensor(self.degree, dtype=torch.float32, device=device)
+        angle = degree[torch.randint(0, len(self.degree), (n,), device=device)] * math.pi / 180
+        # torch.where instead of boolean indexing, which syncs the host
+        flip_x = torch.ones(n, device=device)
+        flip_y = torch.ones(n, device=device)
+        if 'h' in self.mode and 'v' in self.mode:
+            random_factor = torch.rand(n, device=device)
+            flip_x = torch.where(random_factor < 0.3, -flip_x, flip_x)
+            flip_y = torch.where((random_factor >= 0.3) & (random_factor < 0.6), -flip_y, flip_y)
+        elif 'h' in self.mode:
+            flip_x = torch.where(torch.rand(n, device=device) > 0.5, -flip_x, flip_x)
+        elif 'v' in self.mode:
+            flip_y = torch.where(torch.rand(n, device=device) > 0.5, -flip_y, flip_y)
+
+        # output -> input coordinates, the inverse of the cv2 matrix (zoom 1 / zoom) of RandomAffine2D
+        cos, sin = torch.cos(angle) * zoom, torch.sin(angle) * zoom
+        theta = torch.zeros(n, 2, 3, device=device)
+        theta[:,0,0] = cos * flip_x
+        theta[:,0,1] = -sin * flip_y
+        theta[:,1,0] = sin * flip_x
+        theta[:,1,1] = cos * flip_y
+        # shift of the output, in normalized coordinates (the image spans [-1,1])
+        shift = torch.empty(n, 2, device=device).uniform_(-self.translate, self.translate) * 2
+        theta[:,:,2] = -torch.bmm(theta[:,:,:2], shift.unsqueeze(2)).squeeze(2)
+
+        grid = F.affine_grid(theta, image.size(), align_corners=False)
+        return _grid_sample(image, mask, grid)
+
+
+class BatchRandomDistort2D(object):
+    '''
+    Batched elastic distortion, the random displacement is drawn on a coarse grid, blurred and upsampled.
+    Args:
+    - alpha: float, displacement scale in pixel
+    - sigma: float, gaussian blur sigma in pixel
+    - grid_scale: integer, downsampling factor of the displacement grid
+    - prob: the distortion is applied if a uniform draw is larger than prob
+    '''
+    def __init__(self, alpha=200, sigma=20, grid_scale=4, prob=0.5):
+        self.alpha = alpha
+        self.sigma = sigma
+        self.grid_scale = grid_scale
+        self.prob = prob
+        # identity grid and blur kernel, computed once per shape and device
+        self.base_grid = {}
+        self.kernel = {}
+
+    def _get_base_grid(self, size, device):
+        key = (tuple(size[2:]), device)
+        if key not in self.base_grid:
+            theta = torch.eye(2, 3, device=device).unsqueeze(0)
+            self.base_grid[key] = F.affine_grid(theta, (1, 1) + tuple(size[2:]), align_corners=False)
+        return self.base_grid[key]
+
+    def __call__(self, image, mask):
+        n, _, h, w = image.size()
+        device = image.device
+        alpha = self.alpha // self.grid_scale
+        sigma = max(self.sigma // self.grid_scale, 1)
+
+        grid_shape = (h // self.grid_scale, w // self.grid_scale)
+        displacement = torch.rand((n, 2) + grid_shape, device=device) * 2 - 1
+        if device not in self.kernel:
+            self.kernel[device] = _gaussian_kernel(sigma, device)
+        kernel = self.kernel[device]
+        size = kernel.numel()
+        displacement = displacement.view(n * 2, 1, *grid_shape)
+        displacement = F.conv2d(F.pad(displacement, (size//2, size//2, 0, 0), mode='reflect'), kernel.view(1,1,1,-1))
+        displacement = F.conv2d(F.pad(displacement, (0, 0, size//2, size//2), mode='reflect'), kernel.view(1,1,-1,1))
+        displacement = displacement.view(n, 2, *grid_shape) * alpha
+        if self.grid_scale > 1:
+            displacement = F.interpolate(displacement, size=(h, w), mode='bilinear', align_corners=False)
+
+        apply = (torch.rand(n, device=device) > self.prob).float().view(n, 1, 1, 1)
+        # pixel -> normalized coordinates
+        displacement = displacement * apply * torch.tensor([2. / w, 2. / h], device=device).view(1, 2, 1, 1)
+        grid = self._get_base_grid(image.size(), device) + displacement.permute(0, 2, 3, 1)
+
+        return _grid_sample(image, mask, grid)
+
+
+class BatchRandomNoise2D(object):
+    '''
+    Batched salt-and-pepper noise with a probability, as skimage.util.random_noise(mode='s&p').
+    Args:
+    - prob: the noise is added if a uniform draw is larger than prob
+    - amount: proportion of the replaced pixels
+    '''
+    def __init__(self, prob=0.9, amount=0.05):
+        self.prob = prob
+        self.amount = amount
+
+    def __call__(self, image, mask):
+        n = image.size(0)
+        apply = (torch.rand(n, device=image.device) > self.prob).view(n, 1, 1, 1)
+        noise = (torch.rand_like(image) < self.amount) & apply
+        salt = torch.rand_like(image) < 0.5
+        image = torch.where(noise, salt.to(image.dtype), image)
+
+        return image, mask
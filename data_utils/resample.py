@@ -0,0 +1,104 @@
+import numpy as np
+from skimage.transform import resize
+
+
+def _nearest_index(input_size, output_size):
+    # source index of each output pixel center, as the order 0 resize of skimage
+    index = np.floor((np.arange(output_size) + 0.5) * input_size / output_size).astype(np.int64)
+    return np.clip(index, 0, input_size - 1)
+
+
+def resize_label(label, output_shape, num_class=None, mode='nearest'):
+    '''
+    Resize the label map in a single pass, shared by CropResize, prepare_data and Dicom_Reader.
+    Args:
+    - label: numpy array, label map of class index, 2d or 3d
+    - output_shape: tuple of integer
+    - num_class: integer or None, only the classes in [1, num_class) are kept, None to keep all classes
+    - mode: string, 'nearest' or 'linear'
+            'nearest'-> nearest neighbour resize of the label map by index lookup, no float resize, fastest,
+            'linear'-> resize the binary masks of the classes in the label with one multi-channel call
+                       and take the largest class >= 0.5, the same result as resizing class by class.
+    Returns:
+    - float32 label map of output_shape, uint8 for 3d volumes
+    '''
+    output_shape = tuple(output_shape)
+    out_dtype = np.uint8 if label.ndim == 3 else np.float32
+    if mode == 'nearest':
+        new_label = label[np.ix_(*[_nearest_index(i, o) for i, o in zip(label.shape, output_shape)])]
+        if num_class is not None:
+            new_label = np.where(new_label < num_class, new_label, 0)
+        return new_label.astype(out_dtype)
+
+    class_list = np.unique(label).astype(np.uint8)
+    class_list = class_list[class_list != 0]
+    if num_class is not None:
+        class_list = class_list[class_list < num_class]
+    if label.ndim == 3:
+        # one class at a time into a uint8 volume, the stacked float masks of a volume are too large
+        new_label = np.zeros(output_shape, dtype=np.uint8)
+        for z in class_list:
+            roi = resize((label == z).astype(np.float32), output_shape, mode='constant')
+            new_label[roi >= 0.5] = z
+        return new_label
+
+    if len(class_list) == 0:
+        return np.zeros(output_shape, dtype=np.float32)
+
+    # channel last, the resize factor of the channel axis is 1 so channels never mix
+    roi = (label[..., None] == class_list).astype(np.float32)
+    roi = resize(roi, output_shape + (len(class_list), ), mode='constant')
+    roi = roi >= 0.5
+    # the larger class wins on overlap, as in the per-class loop
+    last_index = len(class_list) - 1 - np.argmax(roi[..., ::-1], axis=-1)
+    new_label = np.where(np.any(roi, axis=-1), class_list[last_index], 0)
+
+    return new_label.astype(np.float32)
+
+
+def resize_label_by_class(label, output_shape, num_class):
+    '''
+    Reference implementation, one float resize per class.
+    '''
+    new_label = np.zeros(output_shape, dtype=np.float32)
+    for z in range(1, num_class):
+        roi = resize((label == z).astype(np.float32), output_shape, mode='constant')
+        new_label[roi >= 0.5] = z
+
+    return new_label
+
+
+if __name__ == '__main__':
+
+    import time
+    from skimage.draw import ellipse
+
+    # synthetic 512x512 slices of the TMLI_UP config (7 ROIs + background)
+    num_class = 8
+    np.random.seed(0)
+
+    def get_label(shape):
+        label = np.zeros(shape, dtype=np.float32)
+        for z in np.random.choice(range(1, num_class), 3, replace=False):
+            rr, cc = ellipse(np.random.randint(64, 448), np.random.randint(64, 448),
+                             np.random.randint(4, 64), np.random.randint(4, 64), shape=shape[-2:])
+            label[..., rr, cc] = z
+        return label
+
+    # 2d slices of CropResize, 3d volume of Dicom_Reader (z resampling)
+    setting = [('2d', [get_label((512, 512)) for _ in range(20)], (448, 448)),
+               ('2d', [get_label((512, 512)) for _ in range(20)], (256, 256)),
+               ('3d', [get_label((40, 512, 512)) for _ in range(2)], (60, 448, 448))]
+
+    for name, label_list, output_shape in setting:
+        start = time.time()
+        ref = [resize_label_by_class(label, output_shape, num_class) for label in label_list]
+        loop_time = (time.time() - start) / len(label_list)
+
+        for mode in ['nearest', 'linear']:
+            start = time.time()
+            out = [resize_label(label, output_shape, num_class, mode=mode) for label in label_list]
+            run_time = (time.time() - start) / len(label_list)
+            agree = np.mean([np.mean(a == b) for a, b in zip(ref, out)])
+            print('%s %s: %s %.2f ms, per-class loop %.2f ms, speedup x%.1f, agreement: %.5f' % (
+                name, output_shape, mode, run_time * 1000, loop_time * 1000, loop_time / run_time, agree))
@@ -0,0 +1,85 @@
+import sys
+sys.path.append('..')
+
+import numpy as np
+from torch.utils.data import Sampler
+from utils import get_slice_tags, get_slice_id
+
+
+class ClassBalancedSampler(Sampler):
+    '''
+    Sampler drawing the slices by per-class target frequencies, using the per-slice class tags made by csv_maker.
+    Each draw picks a group (an annotation class, or the empty slices) by its target frequency,
+    then a slice uniformly among the slices of the group. The tags are read once, every epoch is re-drawn in memory.
+    Args:
+    - path_list: list of slice path or slice id, same order as the dataset
+    - tag_csv_path: string, per-slice class tags made by converter.csv_maker
+    - class_freq: list of float or None, target frequency of each annotation class followed by the empty slices,
+                  None for uniform frequency over all groups, the groups without any slice are skipped
+    - num_samples: integer or None, number of slices per epoch, None for the size of path_list
+    - roi_number: integer or None, only the tag of roi_number is used if not None
+    - seed: integer or None, seed of the random generator
+    '''
+    def __init__(self, path_list, tag_csv_path, class_freq=None, num_samples=None, roi_number=None, seed=None):
+        slice_tags = get_slice_tags(tag_csv_path)
+        tag_matrix = np.stack([slice_tags[get_slice_id(case)] for case in path_list], axis=0).astype(bool) #N*(C-1)
+        if roi_number is not None:
+            tag_matrix = tag_matrix[:, [roi_number - 1]]
+        # the empty slices are the last group
+        tag_matrix = np.concatenate([tag_matrix, ~np.any(tag_matrix, axis=1, keepdims=True)], axis=1)
+
+        if class_freq is None:
+            class_freq = np.ones(tag_matrix.shape[1])
+        class_freq = np.asarray(class_freq, dtype=np.float64)
+        assert len(class_freq) == tag_matrix.shape[1], 'class_freq needs one value per class and one for the empty slices'
+
+        self.groups = [np.flatnonzero(tag_matrix[:, i]) for i in range(tag_matrix.shape[1])]
+        class_freq = class_freq * np.array([len(group) > 0 for group in self.groups])
+        self.class_freq = class_freq / np.sum(class_freq)
+        self.num_samples = len(path_list) if num_samples is None else num_samples
+        self.rng = np.random.default_rng(seed)
+
+    def __iter__(self):
+        group_index = self.rng.choice(len(self.groups), self.num_samples, p=self.class_freq)
+        index = np.empty(self.num_samples, dtype=np.int64)
+        for i, group in enumerate(self.groups):
+            draw = group_index == i
+            if np.any(draw):
+                index[draw] = group[self.rng.integers(0, len(group), np.sum(draw))]
+        return iter(index.tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class PatientGroupedSampler(Sampler):
+    '''
+    Sampler keeping neighbouring slices together, for the slice cache of the 2.5d input.
+    The slices of each patient are sorted by index and cut into blocks of block_size consecutive slices,
+    each epoch the order of the blocks is shuffled, with a random shift of the cut.
+    Args:
+    - path_list: list of slice path or slice id (patientID_sliceIndex), same order as the dataset
+    - block_size: integer, number of consecutive slices drawn together
+    - seed: integer or None, seed of the random generator
+    '''
+    def __init__(self, path_list, block_size=8, seed=None):
+        patient = {}
+        for i, case in enumerate(path_list):
+            patient_id, slice_index = get_slice_id(case).rsplit('_', 1)
+            patient.setdefault(patient_id, []).append((int(slice_index), i))
+        self.patient_index = [np.array([i for _, i in sorted(item)], dtype=np.int64) for item in patient.values()]
+        self.block_size = block_size
+        self.num_samples = len(path_list)
+        self.rng = np.random.default_rng(seed)
+
+    def __iter__(self):
+        blocks = []
+        for index in self.patient_index:
+            shift = self.rng.integers(0, self.block_size)
+            cut = np.arange(self.block_size - shift, len(index), self.block_size)
+            blocks.extend(np.split(index, cut))
+        order = self.rng.permutation(len(blocks))
+        return iter(np.concatenate([blocks[i] for i in order]).tolist())
+
+    def __len__(self):
+        return self.num_samples
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import torch
 from PIL import Image,ImageOps
@@ -221,6 +222,74 @@ class RandomZoom2D(object):
 
 
 
+class RandomAffine2D(object):
+    """
+    Data augmentation method.
+    Zoom, rotation, flipping and translation composed into a single affine matrix,
+    the image and mask are warped only once.
+    Args:
+    - scale: the zoom factor from the scale, < 1 for zooming in as RandomZoom2D
+    - degree: the rotate degree from the list
+    - mode: string, consisting of 'h' and 'v', the flipping mode of RandomFlip2D, '' for no flipping
+    - translate: the max shift, in the fraction of the image size
+    Returns:
+    - transformed image and mask, keep original size
+    """
+
+    def __init__(self, scale=(0.8,1.2), degree=[-15,-10,-5,0,5,10,15], mode='v', translate=0.05):
+        assert isinstance(scale,tuple)
+        self.scale = scale
+        self.degree = degree
+        self.mode = mode
+        self.translate = translate
+
+    def _get_flip(self):
+        flip_x, flip_y = 1, 1
+        if 'h' in self.mode and 'v' in self.mode:
+            random_factor = np.random.uniform(0, 1)
+            if random_factor < 0.3:
+                flip_x = -1
+            elif random_factor < 0.6:
+                flip_y = -1
+        elif 'h' in self.mode:
+            if np.random.uniform(0, 1) > 0.5:
+                flip_x = -1
+        elif 'v' in self.mode:
+            if np.random.uniform(0, 1) > 0.5:
+                flip_y = -1
+        return flip_x, flip_y
+
+    def __call__(self, sample):
+        image = sample['image']
+        mask = sample['mask']
+        h, w = image.shape
+        # pixel centers of cv2, the flip is exact about this center
+        center = ((w - 1) / 2., (h - 1) / 2.)
+
+        # sample all parameters up front
+        scale_factor = random.uniform(self.scale[0],self.scale[1])
+        rotate_degree = random.choice(self.degree)
+        flip_x, flip_y = self._get_flip()
+        shift_x = random.uniform(-self.translate, self.translate) * w
+        shift_y = random.uniform(-self.translate, self.translate) * h
+
+        # flip about the center -> rotate and zoom about the center -> shift
+        flip_mat = np.array([[flip_x, 0, center[0] * (1 - flip_x)],
+                             [0, flip_y, center[1] * (1 - flip_y)],
+                             [0, 0, 1]], dtype=np.float64)
+        rotate_mat = cv2.getRotationMatrix2D(center, rotate_degree, 1. / scale_factor)
+        warp_mat = np.matmul(rotate_mat, flip_mat)
+        warp_mat[:, 2] += (shift_x, shift_y)
+
+        image = cv2.warpAffine(image.astype(np.float32), warp_mat, (w, h),
+                               flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        mask = cv2.warpAffine(np.uint8(mask), warp_mat, (w, h),
+                              flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+        return {'image': image, 'mask': mask.astype(np.float32)}
+
+
+
 class RandomAdjust2D(object):
     """
     Data augmentation method.
@@ -279,71 +348,84 @@ class RandomGaussionNoise2D(object):
 class RandomDistort2D(object):
     """
     Data augmentation method.
-    Add random salt-and-pepper noise to the image with a probability.
+    Elastic distortion with a probability.
+    The smooth random displacement is drawn on a coarse grid (1/grid_scale of the image),
+    from a bank of pre-generated fields with random sign, and upsampled to the image size.
+    The pixel grid is computed once per image shape and the parameters are kept across calls.
+    Args:
+    - random_state: integer or None, seed of the displacement bank
+    - alpha: displacement scale in pixel of the full image
+    - sigma: gaussian blur sigma in pixel of the full image
+    - grid_scale: integer, downsampling factor of the displacement grid
+    - prob: the distortion is applied if a uniform draw is larger than prob
+    - bank_size: number of pre-generated displacement fields per shape, 0 to draw a new field every call
     Returns:
-    - adjusted image
+    - distorted image and mask
     """
-    def __init__(self,random_state=None,alpha=200,sigma=20,grid_scale=4,prob=0.5):
+    def __init__(self,random_state=None,alpha=200,sigma=20,grid_scale=4,prob=0.5,bank_size=64):
         self.random_state = random_state
         self.alpha = alpha
         self.sigma = sigma
         self.grid_scale = grid_scale
         self.prob = prob
+        self.bank_size = bank_size
+
+        self.pid = None
+        self.meshgrid = {}
+        self.bank = {}
+
+    def _get_random_state(self):
+        # a new generator in each worker, otherwise the forked workers draw the same fields
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            seed = None if self.random_state is None else self.random_state + self.pid
+            self.rng = np.random.RandomState(seed)
+            self.bank = {}
+        return self.rng
+
+    def _get_meshgrid(self, shape):
+        if shape not in self.meshgrid:
+            grid_x, grid_y = np.meshgrid(np.arange(shape[1], dtype=np.float32), np.arange(shape[0], dtype=np.float32))
+            self.meshgrid[shape] = (grid_x, grid_y)
+        return self.meshgrid[shape]
+
+    def _new_field(self, rng, grid_shape):
+        # alpha and sigma are given at the full resolution
+        alpha = self.alpha // self.grid_scale
+        sigma = max(self.sigma // self.grid_scale, 1)
+        blur_size = int(4 * sigma) | 1
+        field = rng.rand(2, *grid_shape).astype(np.float32) * 2 - 1
+        field[0] = cv2.GaussianBlur(field[0], ksize=(blur_size, blur_size), sigmaX=sigma)
+        field[1] = cv2.GaussianBlur(field[1], ksize=(blur_size, blur_size), sigmaX=sigma)
+        return field * alpha
+
+    def _get_field(self, shape):
+        rng = self._get_random_state()
+        grid_shape = (shape[0]//self.grid_scale, shape[1]//self.grid_scale)
+        if self.bank_size <= 0:
+            return self._new_field(rng, grid_shape)
+        if grid_shape not in self.bank:
+            self.bank[grid_shape] = np.stack([self._new_field(rng, grid_shape) for _ in range(self.bank_size)], axis=0)
+        field = self.bank[grid_shape][rng.randint(self.bank_size)]
+        sign = rng.choice([-1, 1], size=(2, 1, 1)).astype(np.float32)
+        return field * sign
 
     def __call__(self, sample):
         if np.random.uniform(0, 1) > self.prob:
             image = sample['image']
             mask = sample['mask']
+            shape = image.shape[:2]
 
-            if self.random_state is None:
-                random_state = np.random.RandomState(None)
-
-            im_merge = np.concatenate((image[...,None], mask[...,None]), axis=2)
-            shape = im_merge.shape
-            shape_size = shape[:2]
-
-            self.alpha //= self.grid_scale  # Does scaling these make sense? seems to provide
-            self.sigma //= self.grid_scale  # more similar end result when scaling grid used.
-            grid_shape = (shape_size[0]//self.grid_scale, shape_size[1]//self.grid_scale)
-
-            blur_size = int(4 * self.sigma) | 1
-            rand_x = cv2.GaussianBlur(
-                (random_state.rand(*grid_shape) * 2 - 1).astype(np.float32),
-                ksize=(blur_size, blur_size), sigmaX=self.sigma) * self.alpha
-            rand_y = cv2.GaussianBlur(
-                (random_state.rand(*grid_shape) * 2 - 1).astype(np.float32),
-                ksize=(blur_size, blur_size), sigmaX=self.sigma) * self.alpha
+            rand_x, rand_y = self._get_field(shape)
             if self.grid_scale > 1:
-                rand_x = cv2.resize(rand_x, shape_size[::-1])
-                rand_y = cv2.resize(rand_y, shape_size[::-1])
-
-            grid_x, grid_y = np.meshgrid(np.arange(shape_size[1]), np.arange(shape_size[0]))
-            grid_x = (grid_x + rand_x).astype(np.float32)
-            grid_y = (grid_y + rand_y).astype(np.float32)
-
-            distorted_img = cv2.remap(im_merge, grid_x, grid_y, borderMode=cv2.BORDER_REFLECT_101, interpolation=cv2.INTER_LINEAR)
-            '''
-            alpha, sigma, alpha_affine = im_merge.shape[1] * 2, im_merge.shape[1] * 0.08, im_merge.shape[1] * 0.08
-
-            # Random affine
-            center_square = np.float32(shape_size) // 2
-            square_size = min(shape_size) // 3
-
-            pts1 = np.float32([center_square + square_size, [center_square[0]+square_size, center_square[1]-square_size], center_square - square_size])
-            pts2 = pts1 + random_state.uniform(-alpha_affine, alpha_affine, size=pts1.shape).astype(np.float32)
-            M = cv2.getAffineTransform(pts1, pts2)
-            im_merge = cv2.warpAffine(im_merge, M, shape_size[::-1], borderMode=cv2.BORDER_REFLECT_101)
-
-            dx = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma) * alpha
-            dy = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma) * alpha
-            dz = np.zeros_like(dx)
+                rand_x = cv2.resize(rand_x, shape[::-1])
+                rand_y = cv2.resize(rand_y, shape[::-1])
 
-            x, y, z = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]), np.arange(shape[2]))
-            indices = np.reshape(y+dy, (-1, 1)), np.reshape(x+dx, (-1, 1)), np.reshape(z, (-1, 1))
+            grid_x, grid_y = self._get_meshgrid(shape)
+            grid_x = grid_x + rand_x
+            grid_y = grid_y + rand_y
 
-            distorted_img = map_coordinates(im_merge, indices, order=1, mode='reflect').reshape(shape)
-            '''
-            sample['image'] = distorted_img[...,0]
-            sample['mask']  = distorted_img[...,1]
+            sample['image'] = cv2.remap(image.astype(np.float32), grid_x, grid_y, borderMode=cv2.BORDER_REFLECT_101, interpolation=cv2.INTER_LINEAR)
+            sample['mask'] = cv2.remap(np.uint8(mask), grid_x, grid_y, borderMode=cv2.BORDER_REFLECT_101, interpolation=cv2.INTER_NEAREST).astype(np.float32)
 
         return sample
@@ -1,5 +1,5 @@
 import numpy as np
-from skimage.transform import warp
+from scipy.ndimage import affine_transform
 from transforms3d.euler import euler2mat
 from transforms3d.affines import compose
 
@@ -9,6 +9,9 @@ class RandomTranslationRotationZoom3D(object):
     '''
     Data augmentation method.
     Including random translation, rotation and zoom, which keep the shape of input.
+    The 4x4 matrix is applied by scipy.ndimage.affine_transform, which computes the
+    coordinates on the fly instead of building the full coordinate grid,
+    the image is warped with linear interpolation and the label map once with nearest.
     Args:
     - mode: string, consisting of 't','r' or 'z'. Optional methods and 'trz'is default.
             't'-> translation,
@@ -24,17 +27,7 @@ class RandomTranslationRotationZoom3D(object):
         # label: numpy array
         image = sample['image']
         label = sample['mask']
-        # get transform coordinate
         img_size = image.shape
-        coords0, coords1, coords2 = np.mgrid[:img_size[0], :img_size[1], :
-                                             img_size[2]]
-        coords = np.array([
-            coords0 - img_size[0] / 2, coords1 - img_size[1] / 2,
-            coords2 - img_size[2] / 2
-        ])
-        tform_coords = np.append(coords.reshape(3, -1),
-                                 np.ones((1, np.prod(img_size))),
-                                 axis=0)
         # transform configuration
         # translation
         if 't' in self.mode:
@@ -64,19 +57,14 @@ class RandomTranslationRotationZoom3D(object):
         # compose
         warp_mat = compose(translation, rotation, zoom)
 
-        # transform
-        w = np.dot(warp_mat, tform_coords)
-        w[0] = w[0] + img_size[0] / 2
-        w[1] = w[1] + img_size[1] / 2
-        w[2] = w[2] + img_size[2] / 2
-        warp_coords = w[0:3].reshape(3, img_size[0], img_size[1], img_size[2])
-
-        image = warp(image, warp_coords)
-        new_label = np.zeros(label.shape, dtype=np.float32)
-        for z in range(1,self.num_class):
-            temp = warp((label == z).astype(np.float32),warp_coords)
-            new_label[temp >= 0.5] = z
-        label = new_label   
+        # output voxel o samples the input at warp_mat * (o - center) + center
+        center = np.array(img_size, dtype=np.float64) / 2
+        matrix = warp_mat[:3, :3]
+        offset = warp_mat[:3, 3] + center - np.dot(matrix, center)
+
+        image = affine_transform(image.astype(np.float32), matrix, offset=offset, order=1, mode='constant', cval=0.0)
+        label = affine_transform(label.astype(np.uint8), matrix, offset=offset, order=0, mode='constant', cval=0)
+        label = label.astype(np.float32)
         new_sample = {'image': image, 'mask': label}
 
         return new_sample
@@ -5,9 +5,9 @@ import pandas as pd
 import torch
 from torch.utils.data import DataLoader
 from torchvision import transforms
-from data_utils.data_loader import DataGenerator, To_Tensor, CropResize, Trunc_and_Normalize
+from data_utils.data_loader import DataGenerator, VolumeSliceGenerator, To_Tensor, CropResize, Trunc_and_Normalize, PreprocessCache
 from torch.cuda.amp import autocast as autocast
-from utils import get_weight_path,multi_dice,multi_hd
+from utils import get_weight_path,multi_dice,multi_hd,get_slice_index,SliceCatalog,sliding_window_inference
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -110,22 +110,45 @@ def get_net(net_name,encoder_name,channels=1,num_classes=2,input_shape=(512,512)
 
 
 def eval_process(test_path,config):
+    # full-resolution slices and sliding windows for the patch-trained nets
+    slice_shape = config.input_shape if config.patch_size is None else None
+    net_shape = config.input_shape if config.patch_size is None else config.patch_size
     # data loader
     test_transformer = transforms.Compose([
                 Trunc_and_Normalize(config.scale),
-                CropResize(dim=config.input_shape,num_class=config.num_classes,crop=config.crop),
-                To_Tensor(num_class=config.num_classes)
+                CropResize(dim=slice_shape,num_class=config.num_classes,crop=config.crop),
+                To_Tensor(num_class=config.num_classes,one_hot=False)
             ])
 
-    test_dataset = DataGenerator(test_path,
+    preprocess_cache = None
+    if config.cache_dir is not None:
+        preprocess_cache = PreprocessCache(config.cache_dir,config.scale,slice_shape,config.num_classes,config.crop,config.roi_number)
+        test_transformer = To_Tensor(num_class=config.num_classes,one_hot=False)
+
+    if config.context > 0:
+        # the slices of a patient are sorted, the neighbouring stacks share the cached slices
+        test_dataset = VolumeSliceGenerator(test_path,
+                                roi_number=config.roi_number,
+                                num_class=config.num_classes,
+                                transform=test_transformer,
+                                index_path=config.index_path,
+                                preprocess_cache=preprocess_cache,
+                                catalog_path=config.catalog_path,
+                                context=config.context)
+    else:
+        test_dataset = DataGenerator(test_path,
                                 roi_number=config.roi_number,
                                 num_class=config.num_classes,
-                                transform=test_transformer)
+                                transform=test_transformer,
+                                index_path=config.index_path,
+                                preprocess_cache=preprocess_cache,
+                                catalog_path=config.catalog_path)
 
+    # the slice cache lives in each worker, a single worker sees all the neighbouring stacks
     test_loader = DataLoader(test_dataset,
                             batch_size=1,
                             shuffle=False,
-                            num_workers=2,
+                            num_workers=1 if config.context > 0 else 2,
                             pin_memory=True)
     
     # get weight
@@ -133,8 +156,8 @@ def eval_process(test_path,config):
     print(weight_path)
 
     # get net
-    net = get_net(config.net_name,config.encoder_name,config.channels,config.num_classes,config.input_shape)
-    checkpoint = torch.load(weight_path)
+    net = get_net(config.net_name,config.encoder_name,config.channels,config.num_classes,net_shape)
+    checkpoint = torch.load(weight_path, weights_only=False)
     # print(checkpoint['state_dict'])
     net.load_state_dict(checkpoint['state_dict'])
 
@@ -151,13 +174,16 @@ def eval_process(test_path,config):
             data = data.cuda()
 
             with autocast(True):
-                output = net(data)
+                if config.patch_size is not None:
+                    output = sliding_window_inference(net,data,config.patch_size)
+                else:
+                    output = net(data)
             if isinstance(output,tuple) or isinstance(output,list):
                 seg_output = output[0]
             else:
                 seg_output = output
             seg_output = torch.argmax(torch.softmax(seg_output, dim=1),1).detach().cpu().numpy()                          
-            target = torch.argmax(target,1).detach().cpu().numpy()
+            target = target.numpy()
             pred.append(seg_output)
             true.append(target)
     pred = np.concatenate(pred,axis=0)
@@ -169,10 +195,20 @@ def eval_process(test_path,config):
 class Config:
     input_shape = (512,512) #(256,256)(512,512)(448,448) 
     num_classes = 8
-    channels = 1
+    # neighbouring slices on each side of the 2.5d input (channels = 2*context+1), needs index_path
+    context = 0
+    channels = 2 * context + 1
     crop = 0
     scale = (-200,600)
     roi_number = None
+    # patch size of the patch-trained net, None if trained on resized slices
+    patch_size = None #(256,256)
+    # index of the packed test slice store, None if one hdf5 file per slice
+    index_path = None
+    # deterministic preprocessing cache shared by all folds, None to disable
+    cache_dir = None
+    # slice catalog of the test slices, None to scan the test directory
+    catalog_path = None
     net_name = 'deeplabv3+'
     encoder_name = 'resnet50'
     version = 'v4.3-pretrain'
@@ -190,6 +226,10 @@ if __name__ == '__main__':
     sample_list.sort()
     start = time.time()
     config = Config()
+    if config.catalog_path is not None:
+        catalog = SliceCatalog(config.catalog_path)
+    elif config.index_path is not None:
+        slice_index = get_slice_index(config.index_path)
     
     for fold in range(1,6):
         print('>>>>>>>>>>>> Fold%d >>>>>>>>>>>>'%fold)
@@ -205,8 +245,15 @@ if __name__ == '__main__':
             info_item_dice.append(sample)
             info_item_hd.append(sample)
             print('>>>>>>>>>>>> %s is being processed'%sample)
-            test_path = [case.path for case in os.scandir(data_path) if case.name.split('_')[0] == sample]
-            test_path.sort(key=lambda x:eval(x.split('_')[-1].split('.')[0]))
+            if config.catalog_path is not None:
+                # sorted by slice index
+                test_path = catalog.select(patient=sample)
+            else:
+                if config.index_path is not None:
+                    test_path = [case for case in slice_index.keys() if case.split('_')[0] == sample]
+                else:
+                    test_path = [case.path for case in os.scandir(data_path) if case.name.split('_')[0] == sample]
+                test_path.sort(key=lambda x:eval(x.split('_')[-1].split('.')[0]))
             print(len(test_path))
             pred,true = eval_process(test_path,config)
             
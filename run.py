@@ -12,6 +12,10 @@
 
 import os
 import argparse
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import torch
 from trainer import SemanticSeg
 import pandas as pd
 import random
@@ -19,7 +23,8 @@ from PIL import Image
 from sklearn.metrics import classification_report
 from sklearn.metrics import confusion_matrix
 
-from config import INIT_TRAINER, SETUP_TRAINER, CURRENT_FOLD, PATH_LIST, FOLD_NUM, ROI_NAME,TEST_PATH
+from config import INIT_TRAINER, SETUP_TRAINER, CURRENT_FOLD, PATH_LIST, FOLD_NUM, ROI_NAME,TEST_PATH,CATALOG_PATH
+from utils import SliceCatalog
 from config import VERSION, ROI_NAME, DISEASE, MODE
 import time
 
@@ -54,9 +59,17 @@ def get_cross_validation_by_specificed(path_list, val_sample=None):
 
 
 
-def get_cross_validation_by_sample(path_list, fold_num, current_fold):
+def get_patient_list(path_list, catalog=None):
+    # patient id of each slice, looked up in the slice catalog if given
+    if catalog is not None:
+        return catalog.get_column('patient', path_list).tolist()
+    return [os.path.basename(case).split('_')[0] for case in path_list]
 
-    sample_list = list(set([os.path.basename(case).split('_')[0] for case in path_list]))
+
+def get_cross_validation_by_sample(path_list, fold_num, current_fold, catalog=None):
+
+    patient_list = get_patient_list(path_list, catalog)
+    sample_list = list(set(patient_list))
     print('sample len:',len(sample_list))
     sample_list.sort()        
     _len_ = len(sample_list) // fold_num
@@ -73,10 +86,11 @@ def get_cross_validation_by_sample(path_list, fold_num, current_fold):
         train_id.extend(sample_list[:start_index])
         train_id.extend(sample_list[end_index:])
 
+    train_id = set(train_id)
     train_path = []
     validation_path = []
-    for case in path_list:
-        if os.path.basename(case).split('_')[0] in train_id:
+    for case, patient in zip(path_list, patient_list):
+        if patient in train_id:
             train_path.append(case)
         else:
             validation_path.append(case)
@@ -88,6 +102,48 @@ def get_cross_validation_by_sample(path_list, fold_num, current_fold):
     return train_path, validation_path
 
 
+def init_fold_worker(device_queue, num_threads):
+    # each worker process keeps one device set for all its folds
+    global FOLD_DEVICE
+    FOLD_DEVICE = device_queue.get()
+    torch.set_num_threads(num_threads)
+
+
+def train_fold(current_fold, path_list, device=None):
+    '''
+    Train one fold of the cross validation, return the summary of the fold.
+    The slice catalog is read-only and the preprocessing cache is shared on disk by the concurrent folds.
+    Args:
+    - device: string or None, device set of the fold, None for the device set of the worker (or of the config)
+    '''
+    if device is None:
+        device = globals().get('FOLD_DEVICE', INIT_TRAINER['device'])
+    init_trainer = copy.deepcopy(INIT_TRAINER)
+    init_trainer['device'] = device
+    print("=== Training Fold ", current_fold, " on device", device, " ===")
+    segnetwork = SemanticSeg(**init_trainer)
+    print(get_parameter_number(segnetwork.net))
+    catalog = SliceCatalog(CATALOG_PATH) if CATALOG_PATH is not None else None
+    train_path, val_path = get_cross_validation_by_sample(path_list, FOLD_NUM, current_fold, catalog)
+    setup_trainer = copy.deepcopy(SETUP_TRAINER)
+    setup_trainer['train_path'] = train_path
+    setup_trainer['val_path'] = val_path
+    setup_trainer['cur_fold'] = current_fold
+    start_time = time.time()
+    summary = segnetwork.trainer(**setup_trainer)
+    summary['device'] = device
+    summary['run_time'] = time.time() - start_time
+    print('run time:%.4f' % summary['run_time'])
+
+    return summary
+
+
+def save_cv_summary(summary_list, save_path):
+    summary_csv = pd.DataFrame(summary_list).sort_values('fold')
+    print(summary_csv)
+    summary_csv.to_csv(save_path, index=False)
+
+
 def get_parameter_number(net):
     total_num = sum(p.numel() for p in net.parameters())
     trainable_num = sum(p.numel() for p in net.parameters() if p.requires_grad)
@@ -105,6 +161,8 @@ if __name__ == "__main__":
                         type=str)
     parser.add_argument('-s', '--save', default='no', choices=['no', 'n', 'yes', 'y'],
                         help='save the forward middle features or not', type=str)
+    parser.add_argument('-d', '--fold_device', default=None, nargs='+',
+                        help='device set of each concurrent fold in train-cross, e.g. -d 4 5 6 7 or -d 4,5 6,7', type=str)
     args = parser.parse_args()
 
     # Set data path & segnetwork
@@ -112,25 +170,31 @@ if __name__ == "__main__":
         segnetwork = SemanticSeg(**INIT_TRAINER)
         print(get_parameter_number(segnetwork.net))
     path_list = PATH_LIST
+    catalog = SliceCatalog(CATALOG_PATH) if CATALOG_PATH is not None else None
     # Training
     ###############################################
     if args.mode == 'train-cross':
-        for current_fold in range(1, FOLD_NUM + 1):
-            print("=== Training Fold ", current_fold, " ===")
-            segnetwork = SemanticSeg(**INIT_TRAINER)
-            print(get_parameter_number(segnetwork.net))
-            train_path, val_path = get_cross_validation_by_sample(path_list, FOLD_NUM, current_fold)
-            SETUP_TRAINER['train_path'] = train_path
-            SETUP_TRAINER['val_path'] = val_path
-            SETUP_TRAINER['cur_fold'] = current_fold
-            start_time = time.time()
-            segnetwork.trainer(**SETUP_TRAINER)
-
-            print('run time:%.4f' % (time.time() - start_time))
+        summary_list = []
+        if args.fold_device is None or len(args.fold_device) == 1:
+            device = None if args.fold_device is None else args.fold_device[0]
+            for current_fold in range(1, FOLD_NUM + 1):
+                summary_list.append(train_fold(current_fold, path_list, device))
+        else:
+            # one process per device set, the cpu cores are shared by the folds
+            ctx = multiprocessing.get_context('spawn')
+            device_queue = ctx.Queue()
+            for device in args.fold_device:
+                device_queue.put(device)
+            num_threads = max(os.cpu_count() // len(args.fold_device), 1)
+            with ProcessPoolExecutor(max_workers=len(args.fold_device), mp_context=ctx,
+                                     initializer=init_fold_worker, initargs=(device_queue, num_threads)) as executor:
+                futures = [executor.submit(train_fold, current_fold, path_list) for current_fold in range(1, FOLD_NUM + 1)]
+                summary_list = [future.result() for future in futures]
+        save_cv_summary(summary_list, os.path.join(SETUP_TRAINER['output_dir'], 'cv_summary.csv'))
 
 
     if args.mode == 'train':
-        train_path, val_path = get_cross_validation_by_sample(path_list, FOLD_NUM, CURRENT_FOLD)
+        train_path, val_path = get_cross_validation_by_sample(path_list, FOLD_NUM, CURRENT_FOLD, catalog)
         # train_path, val_path = get_cross_validation_by_specificed(path_list, VAL_SAMPLE)
         SETUP_TRAINER['train_path'] = train_path
         SETUP_TRAINER['val_path'] = val_path
@@ -15,17 +15,22 @@ import os
 import torch
 import torch.nn as nn
 from torch.nn import DataParallel
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from tensorboardX import SummaryWriter
 from torchvision import transforms
 import numpy as np
 import math
+import random
 import shutil
 from torch.nn import functional as F
 
 from data_utils.transformer_3d import RandomFlip3D,RandomTranslationRotationZoom3D
-from data_utils.transformer import RandomFlip2D, RandomRotate2D, RandomErase2D,RandomZoom2D,RandomAdjust2D,RandomNoise2D,RandomDistort2D
-from data_utils.data_loader import DataGenerator, To_Tensor, CropResize, Trunc_and_Normalize
+from data_utils.transformer import RandomFlip2D, RandomRotate2D, RandomErase2D,RandomAffine2D,RandomAdjust2D,RandomNoise2D,RandomDistort2D
+from data_utils.gpu_transformer import BatchCompose, BatchRandomErase2D, BatchRandomAffine2D, BatchRandomDistort2D, BatchRandomNoise2D
+from data_utils.sampler import ClassBalancedSampler, PatientGroupedSampler
+from data_utils.data_loader import DataGenerator, PatchGenerator, VolumeSliceGenerator, To_Tensor, CropResize, Trunc_and_Normalize, PreprocessCache, check_memmap_cache
 
 from torch.cuda.amp import autocast as autocast
 
@@ -35,7 +40,7 @@ from tqdm import tqdm
 import warnings
 warnings.filterwarnings('ignore')
 # GPU version.
-from utils import dfs_remove_weight
+from utils import CheckpointWriter, sliding_window_inference
 
 class SemanticSeg(object):
     '''
@@ -50,8 +55,38 @@ class SemanticSeg(object):
     - crop: integer, cropping size
     - batch_size: integer
     - num_workers: integer, how many subprocesses to use for data loading.
+    - index_path: string or None, index of the packed slice store
+    - pool_size: integer, max number of hdf5 files kept open by each data loading worker
+    - mmap_path: string or None, memmap cache of int16/uint8 slices for training and validation,
+                 normalization and one-hot encoding are done on device, no augmentation on CPU,
+                 needs gpu_aug=True (2d seg mode) and a cache built with the same input_shape, crop and scale
+    - compact_mask: True if the loader emits the uint8 label map and the one-hot mask is expanded on device
+    - cache_dir: string or None, directory of the deterministic preprocessing cache for validation and test
+    - gpu_aug: True to run the 2d training augmentation on the batch on gpu instead of per sample in the workers
+    - patch_size: tuple of integer or None, train on patches of full-resolution slices (seg mode only),
+                  validation and test use sliding windows on the full slices
+    - tag_csv_path: string, per-slice class tags made by csv_maker, for the foreground oversampling of patches
+                    and the class-balanced sampler
+    - class_freq: list of float or None, target frequency of each annotation class followed by the empty slices,
+                  to draw the training slices by class with ClassBalancedSampler (seg mode only), None to shuffle
+    - epoch_samples: integer or None, number of training slices per epoch of the class-balanced sampler,
+                     None for the size of the training set
+    - catalog_path: string or None, slice catalog built by converter.csv_maker.build_catalog,
+                    the class labels of the slices are looked up instead of computed from the masks
+    - context: integer, 0 for 2d input, or number of neighbouring slices on each side of the 2.5d input stack,
+               read from the volume store indexed by converter.prepare_data.build_volume_index (index_path),
+               channels should be 2*context+1, the augmentation runs on gpu (seg mode only)
+    - slice_cache_size: integer, max number of decoded slices cached by each worker for the 2.5d input
+    - block_size: integer or None, draw the training slices by blocks of block_size consecutive slices
+                  of a patient with PatientGroupedSampler, so the 2.5d stacks reuse the cached slices, None to shuffle
+    - distributed: True to train with DistributedDataParallel, one process per device launched by torchrun,
+                   the batch_size is split over the processes, only rank 0 writes the logs and checkpoints
+    - dist_backend: string, 'nccl' for gpu, 'gloo' to run the processes on cpu
+    - latest_interval: integer, the full training state is saved as latest.pth every latest_interval epochs, 0 to disable
+    - ckpt_retain: integer, number of the best checkpoints kept while training, 0 to keep all
     - device: string, use the specified device
     - pre_trained: True or False, default False
+    - ckpt_point: True to resume the training from weight_path, with the full training state if it is saved
     - weight_path: weight path of pre-trained model
     - mode: string __all__ = ['cls','seg','cls_and_seg','cls_or_seg']
     '''
@@ -68,6 +103,24 @@ class SemanticSeg(object):
                  crop=0,
                  batch_size=6,
                  num_workers=0,
+                 index_path=None,
+                 pool_size=32,
+                 mmap_path=None,
+                 compact_mask=False,
+                 cache_dir=None,
+                 gpu_aug=False,
+                 patch_size=None,
+                 tag_csv_path=None,
+                 class_freq=None,
+                 epoch_samples=None,
+                 catalog_path=None,
+                 context=0,
+                 slice_cache_size=64,
+                 block_size=None,
+                 distributed=False,
+                 dist_backend='nccl',
+                 latest_interval=1,
+                 ckpt_retain=3,
                  device=None,
                  pre_trained=False,
                  ex_pre_trained=False,
@@ -96,6 +149,27 @@ class SemanticSeg(object):
         self.crop = crop
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.index_path = index_path
+        self.pool_size = pool_size
+        self.mmap_path = mmap_path
+        self.compact_mask = compact_mask
+        self.cache_dir = cache_dir
+        self.gpu_aug = gpu_aug
+        self.patch_size = patch_size
+        self.tag_csv_path = tag_csv_path
+        self.class_freq = class_freq
+        self.epoch_samples = epoch_samples
+        self.catalog_path = catalog_path
+        self.context = context
+        self.slice_cache_size = slice_cache_size
+        self.block_size = block_size
+        self.distributed = distributed
+        self.dist_backend = dist_backend
+        self.latest_interval = latest_interval
+        self.ckpt_retain = ckpt_retain
+        # slices are not resized in patch-based training, the net sees patches
+        self.slice_shape = self.input_shape if self.patch_size is None else None
+        self.net_shape = self.input_shape if self.patch_size is None else self.patch_size
         self.device = device
         self.pre_trained = pre_trained
         self.ex_pre_trained = ex_pre_trained 
@@ -104,6 +178,8 @@ class SemanticSeg(object):
 
         self.start_epoch = 0
         self.global_step = 0
+        # training state to resume, loaded from the checkpoint by _get_pre_trained
+        self.resume_state = None
         self.loss_threshold = 2.0
         self.metrics_threshold = 0.0
 
@@ -117,8 +193,21 @@ class SemanticSeg(object):
         self.topk = topk
         self.freeze = freeze
         self.use_fp16=use_fp16
+        if self.context > 0:
+            assert self.mode == 'seg' and self.index_path is not None, '2.5d input is only for seg mode with a volume index'
+            assert self.channels == 2 * self.context + 1, 'channels should be 2*context+1'
+        if self.mmap_path is not None:
+            # the memmap slices skip the cpu transforms, the augmentation can only run on gpu
+            if not self.gpu_aug or self.mode == 'cls' or len(self.input_shape) != 2:
+                raise ValueError("mmap_path needs gpu_aug=True in 2d seg mode, the training would run without augmentation")
+            check_memmap_cache(self.mmap_path, self.input_shape, self.crop, self.scale)
 
         os.environ['CUDA_VISIBLE_DEVICES'] = self.device
+        self.rank = 0
+        self.world_size = 1
+        self.torch_device = torch.device('cuda')
+        if self.distributed:
+            self._init_distributed()
 
         self.net = self._get_net(self.net_name)
 
@@ -154,21 +243,27 @@ class SemanticSeg(object):
         output_dir = os.path.join(output_dir, "fold" + str(cur_fold))
         log_dir = os.path.join(log_dir, "fold" + str(cur_fold))
 
-        if os.path.exists(log_dir):
-            if not self.pre_trained:
-                shutil.rmtree(log_dir)
+        if self.rank == 0:
+            if os.path.exists(log_dir):
+                if not self.pre_trained:
+                    shutil.rmtree(log_dir)
+                    os.makedirs(log_dir)
+            else:
                 os.makedirs(log_dir)
-        else:
-            os.makedirs(log_dir)
 
-        if os.path.exists(output_dir):
-            if not self.pre_trained:
-                shutil.rmtree(output_dir)
+            if os.path.exists(output_dir):
+                if not self.pre_trained:
+                    shutil.rmtree(output_dir)
+                    os.makedirs(output_dir)
+            else:
                 os.makedirs(output_dir)
-        else:
-            os.makedirs(output_dir)
+        if self.distributed:
+            dist.barrier()
         self.step_pre_epoch = len(train_path) // self.batch_size
-        self.writer = SummaryWriter(log_dir)
+        # only rank 0 writes the logs
+        self.writer = SummaryWriter(log_dir) if self.rank == 0 else NullWriter()
+        # checkpoints are written on a background thread by rank 0
+        ckpt_writer = CheckpointWriter(output_dir, retain=self.ckpt_retain, monitor='val_run_dice') if self.rank == 0 else None
         self.global_step = self.start_epoch * math.ceil(
             len(train_path[0]) / self.batch_size)
 
@@ -184,65 +279,116 @@ class SemanticSeg(object):
         lr = self.lr
         loss = self._get_loss(loss_fun, class_weight)
 
-        if len(self.device.split(',')) > 1:
+        if self.distributed:
+            if self.torch_device.type == 'cuda':
+                # SynchronizedBatchNorm2d is a _BatchNorm, converted as well
+                net = nn.SyncBatchNorm.convert_sync_batchnorm(net)
+            net = net.to(self.torch_device)
+            device_ids = [self.torch_device.index] if self.torch_device.type == 'cuda' else None
+            # the aux classifier is unused in seg mode (and the decoder in cls mode)
+            net = DistributedDataParallel(net, device_ids=device_ids, find_unused_parameters=True)
+        elif len(self.device.split(',')) > 1:
             net = DataParallel(net)
 
         # dataloader setting
+        gpu_transformer = None
+        # in patch-based training the full slice is cropped by PatchGenerator before the patch is drawn
+        train_crop = self.crop if self.patch_size is None else 0
         if self.mode == 'cls':
             train_transformer = transforms.Compose([
                 Trunc_and_Normalize(self.scale),
                 CropResize(dim=self.input_shape,num_class=self.num_classes,crop=self.crop),
                 RandomErase2D(scale_flag=False),
-                RandomZoom2D(),
-                RandomRotate2D(),
-                RandomFlip2D(mode='v'),
+                RandomAffine2D(mode='v'),
                 RandomAdjust2D(),
-                To_Tensor(num_class=self.num_classes)
+                To_Tensor(num_class=self.num_classes,one_hot=not self.compact_mask)
             ])
         else:
             if len(self.input_shape) > 2:
                 train_transformer = transforms.Compose([
                     Trunc_and_Normalize(self.scale),
                     CropResize(dim=self.input_shape,num_class=self.num_classes,crop=self.crop),
-                    # RandomTranslationRotationZoom3D(mode='trz',num_class=self.num_classes),
+                    RandomTranslationRotationZoom3D(mode='trz',num_class=self.num_classes),
                     RandomFlip3D(mode='v'),
-                    To_Tensor(num_class=self.num_classes)
+                    To_Tensor(num_class=self.num_classes,one_hot=not self.compact_mask)
+                ])
+            elif self.gpu_aug or self.context > 0:
+                # the augmentation runs on the batch after the copy to gpu, the cpu transforms are 2d only
+                train_transformer = transforms.Compose([
+                    Trunc_and_Normalize(self.scale),
+                    CropResize(dim=self.slice_shape,num_class=self.num_classes,crop=train_crop),
+                    To_Tensor(num_class=self.num_classes,one_hot=False)
+                ])
+                gpu_transformer = BatchCompose([
+                    BatchRandomErase2D(scale_flag=False),
+                    BatchRandomAffine2D(mode='v'),
+                    BatchRandomDistort2D(),
+                    BatchRandomNoise2D()
                 ])
             else:
                 train_transformer = transforms.Compose([
                     Trunc_and_Normalize(self.scale),
-                    CropResize(dim=self.input_shape,num_class=self.num_classes,crop=self.crop),
+                    CropResize(dim=self.slice_shape,num_class=self.num_classes,crop=train_crop),
                     RandomErase2D(scale_flag=False),
-                    RandomZoom2D(),
+                    RandomAffine2D(mode='v'),
                     RandomDistort2D(),
-                    RandomRotate2D(),
-                    RandomFlip2D(mode='v'),
                     # RandomAdjust2D(),
                     RandomNoise2D(),
-                    To_Tensor(num_class=self.num_classes)
+                    To_Tensor(num_class=self.num_classes,one_hot=not self.compact_mask)
                 ])
-        train_dataset = DataGenerator(train_path,
-                                      roi_number=self.roi_number,
-                                      num_class=self.num_classes,
-                                      transform=train_transformer)
+        if self.patch_size is not None:
+            assert self.mode == 'seg', 'patch-based training is only for seg mode'
+            train_dataset = PatchGenerator(train_path,
+                                           roi_number=self.roi_number,
+                                           num_class=self.num_classes,
+                                           transform=train_transformer,
+                                           index_path=self.index_path,
+                                           pool_size=self.pool_size,
+                                           patch_size=self.patch_size,
+                                           tag_csv_path=self.tag_csv_path,
+                                           crop=self.crop)
+        else:
+            preprocess_cache = None
+            if self.mode != 'cls' and self.cache_dir is not None and len(self.input_shape) == 2:
+                # the truncation, crop and resize are read from the cache, only the random part is left
+                preprocess_cache = PreprocessCache(self.cache_dir,self.scale,self.slice_shape,self.num_classes,self.crop,self.roi_number)
+                train_transformer = transforms.Compose(train_transformer.transforms[2:])
+            train_dataset = self._get_dataset(train_path,
+                                              train_transformer,
+                                              index_path=self.index_path,
+                                              mmap_path=self.mmap_path,
+                                              preprocess_cache=preprocess_cache,
+                                              catalog_path=self.catalog_path)
+
+        train_sampler = None
+        if self.class_freq is not None:
+            assert self.mode == 'seg', 'class-balanced sampling is only for seg mode'
+            train_sampler = ClassBalancedSampler(train_path,
+                                                 tag_csv_path=self.tag_csv_path,
+                                                 class_freq=self.class_freq,
+                                                 num_samples=self.epoch_samples,
+                                                 roi_number=self.roi_number)
+        elif self.block_size is not None:
+            train_sampler = PatientGroupedSampler(train_path, block_size=self.block_size)
+        if self.distributed:
+            assert train_sampler is None, 'class-balanced and patient-grouped sampling are not supported in distributed training'
+            train_sampler = DistributedSampler(train_dataset, shuffle=True, seed=1000)
 
         train_loader = DataLoader(train_dataset,
-                                  batch_size=self.batch_size,
-                                  shuffle=True,
+                                  batch_size=self.batch_size // self.world_size,
+                                  shuffle=(train_sampler is None),
+                                  sampler=train_sampler,
                                   num_workers=self.num_workers,
                                   pin_memory=True,
                                   drop_last=True)
 
         # copy to gpu
-        net = net.cuda()
-        loss = loss.cuda()
+        net = net.to(self.torch_device)
+        loss = loss.to(self.torch_device)
 
         # optimizer setting
         optimizer = self._get_optimizer(optimizer, net, lr)
         scaler = GradScaler()
-        # if self.pre_trained and self.ckpt_point:
-        #     checkpoint = torch.load(self.weight_path)
-            # optimizer.load_state_dict(checkpoint['optimizer'])
 
         if lr_scheduler is not None:
             lr_scheduler = self._get_lr_scheduler(lr_scheduler, optimizer)
@@ -250,8 +396,14 @@ class SemanticSeg(object):
         # loss_threshold = 1.0
 
         early_stopping = EarlyStopping(patience=30,verbose=True,monitor='val_run_dice',op_type='max')
+        summary = {'fold':cur_fold, 'best_epoch':None, 'best_val_run_dice':None, 'last_epoch':None, 'output_dir':output_dir}
+        if self.resume_state is not None:
+            self._load_train_state(self.resume_state, optimizer, lr_scheduler, scaler, early_stopping, summary)
+            self.resume_state = None
         for epoch in range(self.start_epoch, self.n_epoch):
-            train_loss, train_dice, train_acc, train_run_dice = self._train_on_epoch(epoch, net, loss, optimizer, train_loader, scaler)
+            if self.distributed:
+                train_sampler.set_epoch(epoch)
+            train_loss, train_dice, train_acc, train_run_dice = self._train_on_epoch(epoch, net, loss, optimizer, train_loader, scaler, gpu_transformer)
 
             val_loss, val_dice, val_acc, val_run_dice = self._val_on_epoch(epoch, net, loss, val_path)
 
@@ -285,28 +437,26 @@ class SemanticSeg(object):
             #save
             # if val_loss <= self.loss_threshold:
             #     self.loss_threshold = val_loss
+            # the metrics are reduced over the processes, all ranks take the same decisions
+            summary['last_epoch'] = epoch
             if val_run_dice > self.metrics_threshold:
                 self.metrics_threshold = val_run_dice
+                summary.update({'best_epoch':epoch, 'best_val_run_dice':val_run_dice, 'best_val_loss':val_loss,
+                                'best_val_dice':val_dice, 'best_val_acc':val_acc})
 
-                if len(self.device.split(',')) > 1:
-                    state_dict = net.module.state_dict()
-                else:
-                    state_dict = net.state_dict()
-
-                saver = {
-                    'epoch': epoch,
-                    'save_dir': output_dir,
-                    'state_dict': state_dict,
-                    # 'optimizer': optimizer.state_dict()
-                }
+                saver = self._get_train_state(epoch, output_dir, net, optimizer, lr_scheduler, scaler, early_stopping, summary)
 
                 file_name = 'epoch={}-train_loss={:.5f}-train_dice={:.5f}-train_run_dice={:.5f}-train_acc={:.5f}-val_loss={:.5f}-val_dice={:.5f}-val_run_dice={:.5f}-val_acc={:.5f}.pth'.format(
                     epoch, train_loss, train_dice, train_run_dice,train_acc, val_loss,val_dice,val_run_dice,val_acc)
                 
-                save_path = os.path.join(output_dir, file_name)
-                print("Save as: %s" % file_name)
-
-                torch.save(saver, save_path)
+                if self.rank == 0:
+                    print("Save as: %s" % file_name)
+                    ckpt_writer.save(saver, file_name, metric=val_run_dice)
+
+            # the latest state to resume, kept apart from the best checkpoints
+            if self.rank == 0 and self.latest_interval > 0 and (epoch + 1) % self.latest_interval == 0:
+                saver = self._get_train_state(epoch, output_dir, net, optimizer, lr_scheduler, scaler, early_stopping, summary)
+                ckpt_writer.save(saver, 'latest.pth')
             
             #early stopping
             if early_stopping.early_stop:
@@ -314,9 +464,12 @@ class SemanticSeg(object):
                 break
         
         self.writer.close()
-        dfs_remove_weight(output_dir,3)
+        if self.rank == 0:
+            ckpt_writer.close()
 
-    def _train_on_epoch(self, epoch, net, criterion, optimizer, train_loader, scaler):
+        return summary
+
+    def _train_on_epoch(self, epoch, net, criterion, optimizer, train_loader, scaler, gpu_transformer=None):
 
         net.train()
 
@@ -326,15 +479,11 @@ class SemanticSeg(object):
 
         from metrics import RunningDice
         run_dice = RunningDice(labels=range(self.num_classes),ignore_label=-1)
+        # the metrics are accumulated on device, the host only reads them at the logging steps
+        confusion = torch.zeros((self.num_classes, self.num_classes), dtype=torch.int64, device=self.torch_device)
         for step, sample in enumerate(train_loader):
 
-            data = sample['image']
-            target = sample['mask']
-            label = sample['label']
-
-            data = data.cuda()
-            target = target.cuda()
-            label = label.cuda()
+            data, target, label = self._prepare_batch(sample, gpu_transformer)
 
             with autocast(self.use_fp16):
                 output = net(data)
@@ -365,27 +514,22 @@ class SemanticSeg(object):
                 cls_output = torch.sigmoid(cls_output).float()
                 # measure acc
                 acc = accuracy(cls_output.detach(), label)
-                train_acc.update(acc.item(), data.size(0))
+                train_acc.update(acc, data.size(0))
 
             if isinstance(output,list) or isinstance(output,tuple):
-                seg_output = output[0].float() #N*C*H*W
+                seg_output = output[0].detach() #N*C*H*W
             else:
-                seg_output = output.float()
-            seg_output = F.softmax(seg_output, dim=1)
+                seg_output = output.detach()
 
-            loss = loss.float()
+            loss = loss.detach().float()
 
             # measure dice and record loss
-            dice = compute_dice(seg_output.detach(), target)
-            train_loss.update(loss.item(), data.size(0))
-            train_dice.update(dice.item(), data.size(0))
+            matrix, dice = compute_seg_metrics(seg_output, target, self.num_classes)
+            train_loss.update(loss, data.size(0))
+            train_dice.update(dice, data.size(0))
 
-            # measure run dice  
-            seg_output = torch.argmax(seg_output,1).detach().cpu().numpy()  #N*H*W 
-            target = torch.argmax(target,1).detach().cpu().numpy()
-            run_dice.update_matrix(target,seg_output)
-
-            torch.cuda.empty_cache()
+            # measure run dice
+            confusion += matrix
 
             if self.global_step % 10 == 0:
                 if self.mode == 'cls':
@@ -395,6 +539,7 @@ class SemanticSeg(object):
                         'train_acc': acc.item()
                     }, self.global_step)
                 elif self.mode == 'seg':
+                    run_dice.overall_confusion_matrix = confusion.cpu().numpy()
                     rundice, dice_list = run_dice.compute_dice() 
                     print("Category Dice: ", dice_list)
                     print('epoch:{},step:{},train_loss:{:.5f},train_dice:{:.5f},run_dice:{:.5f},lr:{}'.format(epoch, step, loss.item(), dice.item(), rundice, optimizer.param_groups[0]['lr']))
@@ -413,6 +558,12 @@ class SemanticSeg(object):
 
             self.global_step += 1
 
+        for meter in [train_loss, train_dice, train_acc]:
+            meter.to_host()
+        run_dice.overall_confusion_matrix = confusion.cpu().numpy()
+        if self.distributed:
+            self._reduce_metrics([train_loss, train_dice, train_acc], run_dice)
+
         return train_loss.avg, train_dice.avg, train_acc.avg, run_dice.compute_dice()[0]
 
     def _val_on_epoch(self, epoch, net, criterion, val_path, val_transformer=None):
@@ -426,23 +577,33 @@ class SemanticSeg(object):
                 RandomErase2D(scale_flag=False),
                 RandomRotate2D(),
                 RandomFlip2D(mode='hv'),
-                To_Tensor(num_class=self.num_classes)
+                To_Tensor(num_class=self.num_classes,one_hot=not self.compact_mask)
             ])
         else:
             val_transformer = transforms.Compose([
                 Trunc_and_Normalize(self.scale),
-                CropResize(dim=self.input_shape,num_class=self.num_classes,crop=self.crop),
-                To_Tensor(num_class=self.num_classes)
+                CropResize(dim=self.slice_shape,num_class=self.num_classes,crop=self.crop),
+                To_Tensor(num_class=self.num_classes,one_hot=not self.compact_mask)
             ])
 
-        val_dataset = DataGenerator(val_path,
-                                    roi_number=self.roi_number,
-                                    num_class=self.num_classes,
-                                    transform=val_transformer)
+        preprocess_cache = None
+        if self.mode != 'cls' and self.cache_dir is not None:
+            # the preprocessing is cached by the first epoch
+            preprocess_cache = PreprocessCache(self.cache_dir,self.scale,self.slice_shape,self.num_classes,self.crop,self.roi_number)
+            val_transformer = To_Tensor(num_class=self.num_classes,one_hot=not self.compact_mask)
+
+        val_dataset = self._get_dataset(val_path,
+                                        val_transformer,
+                                        index_path=self.index_path,
+                                        mmap_path=self.mmap_path,
+                                        preprocess_cache=preprocess_cache,
+                                        catalog_path=self.catalog_path)
 
+        val_sampler = DistributedSampler(val_dataset, shuffle=False) if self.distributed else None
         val_loader = DataLoader(val_dataset,
-                                batch_size=self.batch_size,
+                                batch_size=self.batch_size // self.world_size,
                                 shuffle=False,
+                                sampler=val_sampler,
                                 num_workers=self.num_workers,
                                 pin_memory=True,
                                 drop_last=True)
@@ -453,18 +614,13 @@ class SemanticSeg(object):
 
         from metrics import RunningDice
         run_dice = RunningDice(labels=range(self.num_classes),ignore_label=-1)
+        confusion = torch.zeros((self.num_classes, self.num_classes), dtype=torch.int64, device=self.torch_device)
         with torch.no_grad():
             for step, sample in enumerate(val_loader):
-                data = sample['image']
-                target = sample['mask']
-                label = sample['label']
-
-                data = data.cuda()
-                target = target.cuda()
-                label = label.cuda()
+                data, target, label = self._prepare_batch(sample)
 
                 with autocast(self.use_fp16):
-                    output = net(data)
+                    output = self._forward(net, data)
                     if self.mode == 'cls':
                         loss = criterion(output[1], label)
                     elif self.mode == 'seg':
@@ -480,33 +636,28 @@ class SemanticSeg(object):
                     cls_output = torch.sigmoid(cls_output).float()
                     # measure acc
                     acc = accuracy(cls_output.detach(), label)
-                    val_acc.update(acc.item(),data.size(0))
+                    val_acc.update(acc,data.size(0))
 
                 if isinstance(output,list) or isinstance(output,tuple):
-                    seg_output = output[0].float() #N*C*H*W
+                    seg_output = output[0] #N*C*H*W
                 else:
-                    seg_output = output.float()
-                seg_output = F.softmax(seg_output, dim=1)
+                    seg_output = output
 
                 loss = loss.float()
 
-
                 # measure dice and record loss
-                dice = compute_dice(seg_output.detach(), target)
-                val_loss.update(loss.item(), data.size(0))
-                val_dice.update(dice.item(), data.size(0))
+                matrix, dice = compute_seg_metrics(seg_output, target, self.num_classes)
+                val_loss.update(loss, data.size(0))
+                val_dice.update(dice, data.size(0))
 
-                # measure run dice  
-                seg_output = torch.argmax(seg_output,1).detach().cpu().numpy()  #N*H*W 
-                target = torch.argmax(target,1).detach().cpu().numpy()
-                run_dice.update_matrix(target,seg_output)
-
-                torch.cuda.empty_cache()
+                # measure run dice
+                confusion += matrix
 
                 if step % 10 == 0:
                     if self.mode == 'cls':
                         print('epoch:{},step:{},val_loss:{:.5f},val_acc:{:.5f}'.format(epoch, step, loss.item(), acc.item()))
                     elif self.mode == 'seg':
+                        run_dice.overall_confusion_matrix = confusion.cpu().numpy()
                         rundice, dice_list = run_dice.compute_dice() 
                         print("Category Dice: ", dice_list)
                         print('epoch:{},step:{},val_loss:{:.5f},val_dice:{:.5f},rundice:{:.5f}'.format(epoch, step, loss.item(), dice.item(),rundice))
@@ -514,13 +665,23 @@ class SemanticSeg(object):
                     else:
                         print('epoch:{},step:{},val_loss:{:.5f},val_dice:{:.5f},val_acc:{:.5f}'.format(epoch, step, loss.item(), dice.item(), acc.item()))
 
+        for meter in [val_loss, val_dice, val_acc]:
+            meter.to_host()
+        run_dice.overall_confusion_matrix = confusion.cpu().numpy()
+        if self.distributed:
+            self._reduce_metrics([val_loss, val_dice, val_acc], run_dice)
+
         return val_loss.avg, val_dice.avg, val_acc.avg,run_dice.compute_dice()[0]
 
-    def test(self, test_path, save_path, net=None, mode='seg', save_flag=False):
+    def test(self, test_path, save_path, net=None, mode='seg', save_flag=False, index_path=None, catalog_path=None):
         if net is None:
             net = self.net
+        if index_path is None:
+            index_path = self.index_path
+        if catalog_path is None:
+            catalog_path = self.catalog_path
         
-        net = net.cuda()
+        net = net.to(self.torch_device)
         net.eval()
         
         if self.mode == 'cls':
@@ -530,19 +691,25 @@ class SemanticSeg(object):
                 RandomErase2D(scale_flag=False),
                 RandomRotate2D(),
                 RandomFlip2D(mode='hv'),
-                To_Tensor(num_class=self.num_classes)
+                To_Tensor(num_class=self.num_classes,one_hot=not self.compact_mask)
             ])
         else:
             test_transformer = transforms.Compose([
                 Trunc_and_Normalize(self.scale),
-                CropResize(dim=self.input_shape,num_class=self.num_classes,crop=self.crop),
-                To_Tensor(num_class=self.num_classes)
+                CropResize(dim=self.slice_shape,num_class=self.num_classes,crop=self.crop),
+                To_Tensor(num_class=self.num_classes,one_hot=not self.compact_mask)
             ])
 
-        test_dataset = DataGenerator(test_path,
-                                    roi_number=self.roi_number,
-                                    num_class=self.num_classes,
-                                    transform=test_transformer)
+        preprocess_cache = None
+        if self.mode != 'cls' and self.cache_dir is not None:
+            preprocess_cache = PreprocessCache(self.cache_dir,self.scale,self.slice_shape,self.num_classes,self.crop,self.roi_number)
+            test_transformer = To_Tensor(num_class=self.num_classes,one_hot=not self.compact_mask)
+
+        test_dataset = self._get_dataset(test_path,
+                                         test_transformer,
+                                         index_path=index_path,
+                                         preprocess_cache=preprocess_cache,
+                                         catalog_path=catalog_path)
 
         test_loader = DataLoader(test_dataset,
                                 batch_size=20,
@@ -564,17 +731,10 @@ class SemanticSeg(object):
 
         with torch.no_grad():
             for step, sample in enumerate(test_loader):
-                data = sample['image']
-                target = sample['mask']
-                label = sample['label'] #N*C
-                # print(label)
-
-                data = data.cuda()
-                target = target.cuda()
-                label = label.cuda()
+                data, target, label = self._prepare_batch(sample) #label: N*C
 
                 with autocast(self.use_fp16):
-                    output = net(data)
+                    output = self._forward(net, data)
 
                 if mode == 'cls':
                     cls_output = output[1]
@@ -623,6 +783,83 @@ class SemanticSeg(object):
 
         return cls_result
 
+    def _init_distributed(self):
+        # the rank, world size and master address are set by torchrun
+        if not dist.is_initialized():
+            dist.init_process_group(backend=self.dist_backend)
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        if self.dist_backend == 'nccl':
+            torch.cuda.set_device(local_rank)
+            self.torch_device = torch.device('cuda', local_rank)
+        else:
+            self.torch_device = torch.device('cpu')
+
+    def _reduce_metrics(self, meters, run_dice):
+        # sum the meters and the confusion matrix over the processes
+        reduce_device = self.torch_device if self.dist_backend == 'nccl' else torch.device('cpu')
+        total = torch.tensor([[meter.sum, meter.count] for meter in meters], dtype=torch.float64, device=reduce_device)
+        dist.all_reduce(total)
+        for meter, (meter_sum, meter_count) in zip(meters, total.tolist()):
+            meter.sum, meter.count = meter_sum, meter_count
+            meter.avg = meter_sum / meter_count if meter_count > 0 else 0
+        if run_dice.overall_confusion_matrix is None:
+            run_dice.overall_confusion_matrix = np.zeros((len(run_dice.labels), ) * 2, dtype=np.int64)
+        matrix = torch.from_numpy(np.asarray(run_dice.overall_confusion_matrix, dtype=np.int64)).to(reduce_device)
+        dist.all_reduce(matrix)
+        run_dice.overall_confusion_matrix = matrix.cpu().numpy()
+
+    def _get_dataset(self, path_list, transform, index_path=None, mmap_path=None, preprocess_cache=None, catalog_path=None):
+        # the 2.5d stacks are read from the volume store
+        if self.context > 0:
+            return VolumeSliceGenerator(path_list,
+                                        roi_number=self.roi_number,
+                                        num_class=self.num_classes,
+                                        transform=transform,
+                                        index_path=index_path,
+                                        pool_size=self.pool_size,
+                                        preprocess_cache=preprocess_cache,
+                                        catalog_path=catalog_path,
+                                        context=self.context,
+                                        slice_cache_size=self.slice_cache_size)
+        return DataGenerator(path_list,
+                             roi_number=self.roi_number,
+                             num_class=self.num_classes,
+                             transform=transform,
+                             index_path=index_path,
+                             pool_size=self.pool_size,
+                             mmap_path=mmap_path,
+                             preprocess_cache=preprocess_cache,
+                             catalog_path=catalog_path)
+
+    def _forward(self, net, data):
+        # full slices are segmented by sliding windows in patch-based training
+        if self.patch_size is not None:
+            return sliding_window_inference(net, data, self.patch_size)
+        return net(data)
+
+    def _prepare_batch(self, sample, gpu_transformer=None):
+        '''
+        Copy the batch to gpu, raw int16 images are normalized, the batched augmentation
+        is applied and uint8 masks are expanded to one-hot after the copy.
+        '''
+        data = sample['image'].to(self.torch_device, non_blocking=True)
+        target = sample['mask'].to(self.torch_device, non_blocking=True)
+        label = sample['label'].to(self.torch_device, non_blocking=True)
+
+        if not torch.is_floating_point(data):
+            data = trunc_and_normalize(data, self.scale)
+        if gpu_transformer is not None:
+            data, target = gpu_transformer(data, target)
+        if target.dim() < data.dim():
+            target = expand_as_one_hot(target, self.num_classes)
+        if gpu_transformer is not None:
+            # class presence after the augmentation
+            label = torch.amax(target.flatten(2), dim=2)[:,1:]
+
+        return data, target, label
+
     def _get_net(self, net_name):
         if net_name == 'unet':
             if self.encoder_name in ['simplenet','swin_transformer','swinplusr18']:
@@ -702,8 +939,8 @@ class SemanticSeg(object):
             config_vit = CONFIGS_ViT_seg['R50-ViT-B_16']
             config_vit.n_classes = self.num_classes 
             config_vit.n_skip = 3 
-            config_vit.patches.grid = (int(self.input_shape[0]/16), int(self.input_shape[1]/16))
-            net = ViT_seg(config_vit, img_size=self.input_shape[0], num_classes=self.num_classes)
+            config_vit.patches.grid = (int(self.net_shape[0]/16), int(self.net_shape[1]/16))
+            net = ViT_seg(config_vit, img_size=self.net_shape[0], num_classes=self.num_classes)
             #net.load_from(weights=np.load('./initmodel/R50+ViT-B_16.npz')) # uncomment this to use pretrain model download from TransUnet git repo
 
         elif net_name == 'ResNet_UTNet':
@@ -715,7 +952,7 @@ class SemanticSeg(object):
             config = SwinUnet_config()
             config.num_classes = self.num_classes
             config.in_chans = self.channels
-            net = SwinUnet(config, img_size=self.input_shape[0], num_classes=self.num_classes)
+            net = SwinUnet(config, img_size=self.net_shape[0], num_classes=self.num_classes)
             # net.load_from('./initmodel/swin_tiny_patch4_window7_224.pth')
 
         return net
@@ -826,11 +1063,60 @@ class SemanticSeg(object):
         return lr_scheduler
 
     def _get_pre_trained(self, weight_path, ckpt_point=True):
-        checkpoint = torch.load(weight_path)
+        # the full training state holds numpy and python rng states, not loadable with weights_only (default of torch>=2.6)
+        checkpoint = torch.load(weight_path, map_location='cpu', weights_only=False)
         self.net.load_state_dict(checkpoint['state_dict'])
         if ckpt_point:
             self.start_epoch = checkpoint['epoch'] + 1
             # self.loss_threshold = eval(os.path.splitext(self.weight_path.split(':')[-1])[0])
+            if 'optimizer' in checkpoint:
+                self.resume_state = checkpoint
+
+    def _get_train_state(self, epoch, output_dir, net, optimizer, lr_scheduler, scaler, early_stopping, summary):
+        '''
+        Full training state at the end of the epoch, enough to resume the training exactly.
+        '''
+        if isinstance(net, (DataParallel, DistributedDataParallel)):
+            state_dict = net.module.state_dict()
+        else:
+            state_dict = net.state_dict()
+
+        return {
+            'epoch': epoch,
+            'save_dir': output_dir,
+            'state_dict': state_dict,
+            'optimizer': optimizer.state_dict(),
+            'lr_scheduler': lr_scheduler.state_dict() if lr_scheduler is not None else None,
+            'scaler': scaler.state_dict(),
+            'early_stopping': dict(early_stopping.__dict__),
+            'global_step': self.global_step,
+            'metrics_threshold': self.metrics_threshold,
+            'summary': dict(summary),
+            'rng_state': {
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                'numpy': np.random.get_state(),
+                'random': random.getstate()
+            }
+        }
+
+    def _load_train_state(self, checkpoint, optimizer, lr_scheduler, scaler, early_stopping, summary):
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if lr_scheduler is not None and checkpoint['lr_scheduler'] is not None:
+            lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+        scaler.load_state_dict(checkpoint['scaler'])
+        early_stopping.__dict__.update(checkpoint['early_stopping'])
+        summary.update(checkpoint['summary'])
+        self.global_step = checkpoint['global_step']
+        self.metrics_threshold = checkpoint['metrics_threshold']
+
+        rng_state = checkpoint['rng_state']
+        torch.set_rng_state(rng_state['torch'])
+        if rng_state['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng_state['cuda'])
+        np.random.set_state(rng_state['numpy'])
+        random.setstate(rng_state['random'])
+        print('Resume from epoch %d, step %d' % (checkpoint['epoch'], self.global_step))
 
 
 # computing tools
@@ -855,9 +1141,53 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+    def to_host(self):
+        '''
+        Read the values accumulated as device tensors, once at the end of the epoch.
+        '''
+        if torch.is_tensor(self.sum):
+            self.sum = self.sum.item()
+        if torch.is_tensor(self.val):
+            self.val = self.val.item()
+        self.avg = self.sum / self.count if self.count > 0 else 0
+
+
+class NullWriter(object):
+    '''
+    SummaryWriter of the ranks > 0 in distributed training, nothing is written.
+    '''
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+    def add_scalars(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+
+
+
+
+def trunc_and_normalize(image, scale):
+    '''
+    Truncate gray scale and normalize to [0,1], the tensor version of Trunc_and_Normalize
+    '''
+    gray_range = scale[1] - scale[0]
+    image = torch.clamp(image.float() - scale[0], 0, gray_range)
+
+    return image / gray_range
 
 
+def expand_as_one_hot(target, num_classes):
+    '''
+    Expand the label map of shape [N, *] to the one-hot mask of shape [N, C, *]
+    '''
+    dims = (0, target.dim()) + tuple(range(1, target.dim()))
+    target = F.one_hot(target.long(), num_classes).permute(dims)
 
+    return target.float()
 
 
 def binary_dice(predict, target, smooth=1e-5):
@@ -915,6 +1245,48 @@ def compute_dice(predict,target,ignore_index=0):
     return np.nanmean(dice_list[1:])
 
 
+def batch_confusion_matrix(predict, target, num_classes):
+    '''
+    Confusion matrix of each sample computed on device by a single scatter_add, without host synchronization
+    (torch.bincount on cuda reads the min and max of the input back to the host).
+    Args:
+    - predict: label map of class index, N*H*W
+    - target: label map of class index, same shape with predict
+    - num_classes: integer
+    Returns:
+    - int64 tensor, N*C*C, the rows are the ground truth
+    '''
+    n = target.size(0)
+    sample_index = torch.arange(n, device=target.device).view((n,) + (1,) * (target.dim() - 1))
+    index = ((sample_index * num_classes + target) * num_classes + predict).flatten()
+    matrix = torch.zeros(n * num_classes * num_classes, dtype=torch.long, device=index.device)
+    matrix.scatter_add_(0, index, torch.ones_like(index))
+
+    return matrix.view(n, num_classes, num_classes)
+
+
+def compute_seg_metrics(output, target, num_classes, ignore_index=0, smooth=1e-5):
+    '''
+    Sync-free version of compute_dice, the result stays on device.
+    Args:
+    - output: network output, N*C*H*W, softmax is not needed for the argmax
+    - target: one-hot target, N*C*H*W
+    Returns:
+    - confusion matrix of the batch, C*C, for RunningDice
+    - mean dice over the batch, 0-dim tensor, same as compute_dice
+    '''
+    matrix = batch_confusion_matrix(torch.argmax(output, 1), torch.argmax(target, 1), num_classes)
+    inter = torch.diagonal(matrix, dim1=1, dim2=2).float() #N*C
+    union = (matrix.sum(dim=1) + matrix.sum(dim=2)).float() #N*C
+    dice = (2*inter + smooth) / (union + smooth)
+    # the samples with dice 1.0 (class absent in both) are left out, as in binary_dice
+    valid = (dice != 1.0).float()
+    class_dice = (dice * valid).sum(dim=0) / valid.sum(dim=0) #nan for the absent classes
+    class_dice[ignore_index] = float('nan')
+
+    return matrix.sum(dim=0), torch.nanmean(class_dice[1:])
+
+
 def accuracy(output, target):
     '''
     Computes the precision acc
@@ -1,9 +1,12 @@
-import os,glob
+import os,glob,re,time,copy
+import queue
+import threading
 import pandas as pd
 import h5py
 import numpy as np
 import torch
 import random
+from collections import OrderedDict
 from skimage.metrics import hausdorff_distance
 from monai.metrics.hausdorff_distance import compute_hausdorff_distance
 
@@ -68,6 +71,187 @@ def hdf5_reader(data_path, key):
     return image
 
 
+class HDF5Pool(object):
+    '''
+    LRU pool of opened (read-only) hdf5 files.
+    Files are opened lazily on the first read in the current process, and the pool is
+    emptied when it is used from a new process, so it is safe to create it before the
+    DataLoader workers fork.
+    Args:
+    - pool_size: integer, max number of opened files, 0 to close the file after each read
+    '''
+    def __init__(self, pool_size=32):
+        self.pool_size = pool_size
+        self.pid = None
+        self.handles = OrderedDict()
+
+    def _get_file(self, data_path):
+        # never reuse the handles inherited from the parent process
+        if self.pid != os.getpid():
+            self.handles = OrderedDict()
+            self.pid = os.getpid()
+        if data_path in self.handles:
+            self.handles.move_to_end(data_path)
+            return self.handles[data_path]
+
+        hdf5_file = h5py.File(data_path, 'r')
+        if self.pool_size > 0:
+            self.handles[data_path] = hdf5_file
+            while len(self.handles) > self.pool_size:
+                _, lru_file = self.handles.popitem(last=False)
+                lru_file.close()
+        return hdf5_file
+
+    def read(self, data_path, keys, offset=None):
+        '''
+        Read several keys (the whole dataset or the slice at offset) with a single open.
+        '''
+        hdf5_file = self._get_file(data_path)
+        data = []
+        for key in keys:
+            dataset = hdf5_file[key] if offset is None else hdf5_file[key][offset]
+            data.append(np.asarray(dataset, dtype=np.float32))
+        if self.pool_size <= 0:
+            hdf5_file.close()
+
+        return data
+
+    def close(self):
+        if self.pid == os.getpid():
+            for hdf5_file in self.handles.values():
+                hdf5_file.close()
+        self.handles = OrderedDict()
+
+
+class SliceCache(object):
+    '''
+    LRU cache of the decoded slices, kept in each worker process,
+    so that the samples sharing neighbouring slices (2.5d stacks of the same patient) decode them once.
+    The cache is emptied when it is used from a new process, as HDF5Pool.
+    Args:
+    - cache_size: integer, max number of cached slices, 0 to disable
+    '''
+    def __init__(self, cache_size=64):
+        self.cache_size = cache_size
+        self.pid = None
+        self.slices = OrderedDict()
+
+    def get(self, key):
+        if self.pid != os.getpid():
+            self.slices = OrderedDict()
+            self.pid = os.getpid()
+        if key not in self.slices:
+            return None
+        self.slices.move_to_end(key)
+        return self.slices[key]
+
+    def put(self, key, value):
+        if self.cache_size <= 0:
+            return
+        if self.pid != os.getpid():
+            self.slices = OrderedDict()
+            self.pid = os.getpid()
+        self.slices[key] = value
+        self.slices.move_to_end(key)
+        while len(self.slices) > self.cache_size:
+            self.slices.popitem(last=False)
+
+
+def get_slice_index(index_path):
+    '''
+    Load the index of a packed slice store.
+    Return a dict, slice id (patientID_sliceIndex) -> (hdf5 path, offset)
+    '''
+    index_df = pd.read_csv(index_path, dtype={'id':str,'patient':str})
+    return dict(zip(index_df['id'].tolist(), zip(index_df['path'].tolist(), index_df['offset'].tolist())))
+
+
+def get_slice_id(path):
+    '''
+    Slice id (patientID_sliceIndex) of a slice hdf5 path, slice id is returned as it is.
+    '''
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def get_slice_tags(input_path):
+    '''
+    Load the per-slice class tags made by converter.csv_maker, the slice catalog (.npz) is also accepted.
+    Return a dict, slice id -> uint8 array of the presence of each annotation (background excluded)
+    '''
+    if input_path.endswith('.npz'):
+        catalog = SliceCatalog(input_path)
+        return dict(zip(catalog.id, catalog.columns['tags']))
+    csv_file = pd.read_csv(input_path)
+    tag_matrix = np.asarray(csv_file.iloc[:, 1:], dtype=np.uint8)
+    return {get_slice_id(path):tag for path, tag in zip(csv_file['path'].tolist(), tag_matrix)}
+
+
+class SliceCatalog(object):
+    '''
+    Columnar metadata of the 2d slices, built once by converter.csv_maker.build_catalog.
+    One row per slice, the columns are:
+    - id: slice id, patientID_sliceIndex
+    - patient: patient id
+    - slice_index: integer, index of the slice in the volume
+    - path: entry of the DataGenerator path_list, hdf5 path of the slice, or slice id for the packed store
+    - shape: N*2, shape of the slice
+    - tags: N*(C-1) uint8, presence of each annotation (background excluded)
+    - area: N*(C-1) int64, pixel number of each annotation
+    Args:
+    - catalog_path: string, path of the .npz catalog
+    '''
+    def __init__(self, catalog_path):
+        with np.load(catalog_path) as data:
+            self.columns = {key:data[key] for key in data.files}
+        self.id = self.columns['id'].tolist()
+        self.row = {case:i for i, case in enumerate(self.id)}
+
+    def __len__(self):
+        return len(self.id)
+
+    def get_rows(self, path_list):
+        '''
+        Row of each slice path or slice id.
+        '''
+        return np.array([self.row[get_slice_id(case)] for case in path_list], dtype=np.int64)
+
+    def get_column(self, name, path_list=None):
+        '''
+        Column of the slices in path_list, all the slices if path_list is None.
+        '''
+        if path_list is None:
+            return self.columns[name]
+        return self.columns[name][self.get_rows(path_list)]
+
+    def get_label(self, path, roi_number=None):
+        '''
+        float32 class presence of the slice (background excluded), as the label of DataGenerator.
+        '''
+        tags = self.columns['tags'][self.row[get_slice_id(path)]]
+        if roi_number is not None:
+            tags = tags[[roi_number - 1]]
+        return tags.astype(np.float32)
+
+    def select(self, patient=None, roi_number=None, annotated=False):
+        '''
+        DataGenerator path_list of the slices, sorted by patient and slice index.
+        Args:
+        - patient: string, list of string or None, only the slices of the patients are kept if not None
+        - roi_number: integer or None, the annotation checked by annotated, None for any annotation
+        - annotated: True to keep only the slices with annotation
+        '''
+        keep = np.ones((len(self.id), ), dtype=bool)
+        if patient is not None:
+            patient = [patient] if isinstance(patient, str) else patient
+            keep &= np.isin(self.columns['patient'], patient)
+        if annotated:
+            tags = self.columns['tags'] if roi_number is None else self.columns['tags'][:, [roi_number - 1]]
+            keep &= np.any(tags, axis=1)
+        rows = np.flatnonzero(keep)
+        rows = rows[np.lexsort((self.columns['slice_index'][rows], self.columns['patient'][rows]))]
+        return self.columns['path'][rows].tolist()
+
+
 def get_path_with_annotation(input_path,path_col,tag_col):
     path_list = pd.read_csv(input_path)[path_col].values.tolist()
     tag_list = pd.read_csv(input_path)[tag_col].values.tolist()
@@ -95,6 +279,48 @@ def get_path_with_annotation_ratio(input_path,path_col,tag_col,ratio=0.5):
     return with_list + without_list
 
 
+def sliding_window_inference(net, data, patch_size, overlap=0.5):
+    '''
+    Segment the full slice by averaging the logits of overlapping patches.
+    Args:
+    - net: the model trained on patches
+    - data: tensor, N*C*H*W
+    - patch_size: tuple of integer, (H,W) of the patch
+    - overlap: float, overlap ratio of the neighbouring windows
+    Returns:
+    - seg logits of N*num_classes*H*W
+    '''
+    n, _, h, w = data.size()
+    ph, pw = patch_size
+    pad_h, pad_w = max(ph - h, 0), max(pw - w, 0)
+    if pad_h > 0 or pad_w > 0:
+        data = torch.nn.functional.pad(data, (0, pad_w, 0, pad_h))
+    H, W = data.size()[2:]
+
+    def get_start(size, patch):
+        stride = max(int(patch * (1 - overlap)), 1)
+        start = list(range(0, size - patch + 1, stride))
+        if start[-1] != size - patch:
+            start.append(size - patch)
+        return start
+
+    output = None
+    count = torch.zeros((1, 1, H, W), device=data.device)
+    for top in get_start(H, ph):
+        for left in get_start(W, pw):
+            patch_output = net(data[:, :, top:top + ph, left:left + pw])
+            if isinstance(patch_output,list) or isinstance(patch_output,tuple):
+                patch_output = patch_output[0]
+            patch_output = patch_output.float()
+            if output is None:
+                output = torch.zeros((n, patch_output.size(1), H, W), device=data.device)
+            output[:, :, top:top + ph, left:left + pw] += patch_output
+            count[:, :, top:top + ph, left:left + pw] += 1
+
+    output = output / count
+    return output[:, :, :h, :w]
+
+
 def count_params_and_macs(net,input_shape):
     
     from thop import profile
@@ -109,7 +335,8 @@ def count_params_and_macs(net,input_shape):
 def get_weight_path(ckpt_path):
 
     if os.path.isdir(ckpt_path):
-        pth_list = os.listdir(ckpt_path)
+        # best checkpoints only, latest.pth is loaded by name
+        pth_list = [case for case in os.listdir(ckpt_path) if case.startswith('epoch=') and case.endswith('.pth')]
         if len(pth_list) != 0:
             pth_list.sort(key=lambda x:int(x.split('-')[0].split('=')[-1]))
             return os.path.join(ckpt_path,pth_list[-1])
@@ -123,13 +350,102 @@ def get_weight_path(ckpt_path):
 def remove_weight_path(ckpt_path,retain=3):
 
     if os.path.isdir(ckpt_path):
-        pth_list = os.listdir(ckpt_path)
+        pth_list = [case for case in os.listdir(ckpt_path) if case.startswith('epoch=') and case.endswith('.pth')]
         if len(pth_list) >= retain:
             pth_list.sort(key=lambda x:int(x.split('-')[0].split('=')[-1]))
             for pth_item in pth_list[:-retain]:
                 os.remove(os.path.join(ckpt_path,pth_item))
 
 
+def to_cpu(state):
+    '''
+    Copy of the tensors of a (nested) state dict on cpu, the training can go on while it is written.
+    '''
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, to_cpu(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return copy.deepcopy(state)
+
+
+class CheckpointWriter(object):
+    '''
+    Write the checkpoints on a background thread, off the training loop.
+    save() copies the state to cpu, the thread serializes it to a temporary file and renames it,
+    then only the retain best checkpoints (by the monitored metric) are kept, latest.pth is never removed.
+    The existing checkpoints of save_dir (a resumed training) take part in the retention.
+    Args:
+    - save_dir: string, directory of the checkpoints
+    - retain: integer, number of the best checkpoints kept, 0 to keep all
+    - monitor: string, the metric in the checkpoint name, e.g. val_run_dice=0.91234
+    - op_type: string, 'max' or 'min', the best value of the metric
+    '''
+    def __init__(self, save_dir, retain=3, monitor='val_run_dice', op_type='max'):
+        self.save_dir = save_dir
+        self.retain = retain
+        self.op_type = op_type
+        self.best = []
+        pattern = re.compile(re.escape(monitor) + r'=(-?[0-9.]+?)(?:-|\.pth)')
+        for name in os.listdir(save_dir):
+            match = pattern.search(name)
+            if name.startswith('epoch=') and match is not None:
+                self.best.append((float(match.group(1)), os.path.join(save_dir, name)))
+
+        self.latency = []
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, file_name, metric=None):
+        '''
+        - metric: float or None, the checkpoint takes part in the retention if not None
+        '''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((to_cpu(state), file_name, metric))
+
+    def _write(self, state, file_name, metric):
+        start = time.time()
+        save_path = os.path.join(self.save_dir, file_name)
+        torch.save(state, save_path + '.tmp')
+        os.replace(save_path + '.tmp', save_path)
+        self.latency.append(time.time() - start)
+        print('Checkpoint %s written in %.3fs' % (file_name, self.latency[-1]))
+
+        if metric is not None and self.retain > 0:
+            self.best.append((metric, save_path))
+            self.best.sort(key=lambda x: x[0], reverse=(self.op_type == 'max'))
+            for _, old_path in self.best[self.retain:]:
+                if os.path.exists(old_path) and old_path != save_path:
+                    os.remove(old_path)
+            self.best = self.best[:self.retain]
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+                print('Checkpoint writing error: %s' % e)
+
+    def close(self):
+        '''
+        Wait for the pending checkpoints and stop the thread.
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        if len(self.latency) != 0:
+            print('Checkpoint writing: %d files, mean %.3fs, max %.3fs' % (len(self.latency), np.mean(self.latency), np.max(self.latency)))
+        if self.error is not None:
+            raise self.error
+
+
 def dfs_remove_weight(ckpt_path,retain=3):
     for sub_path in os.scandir(ckpt_path):
         if sub_path.is_dir():